@@ -1,15 +1,27 @@
+import functools
+import hashlib
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from load_data import ConversionTable
-from load_data import ReferenceData
-from functions import normalization_pipeline, get_table_download_link
-
-# Load the conversion tables
-sdmt_conv_table = ConversionTable().sdmt
-bvmt_conv_table = ConversionTable().bvmt
-cvlt_conv_table = ConversionTable().cvlt
+import numpy as np
+from load_data import get_mock_preview, get_reference_density
+from norms import DEFAULT_NORM, get_norm_registry
+from functions import batch_normalization
+from export import EXPORT_FORMATS, get_export_formats
+from ingest import check_output_rows
+from pipeline import UploadPipeline
+from jobs import DONE, FAILED, JOB_THRESHOLD_MB, job_queue
+from summary import GROUP_COLUMNS, HISTOGRAM_EDGES
+from metrics import METRICS_PANEL, measure, metrics_registry, start_metrics_server
+from prewarm import start_prewarm
+
+# Load the assets and matplotlib in the background while the top of the page renders, once per process
+start_prewarm()
+
+# Serve the metrics in the Prometheus format if BICAMS_METRICS and BICAMS_METRICS_PORT are set
+start_metrics_server()
+
+# Load the norm sets in data/norms
+norm_registry = get_norm_registry()
 
 # Initiate some options
 sex_options = ['1 - Male', '2 - Female']
@@ -59,6 +71,11 @@ edu = st.sidebar.selectbox(
     options = edu_options)
 edu_int = int(edu.split(' - ')[0]) # Only get the amount of years from the education string
 
+norm = st.sidebar.selectbox(
+    label = 'Define norm set',
+    options = norm_registry.names,
+    index = norm_registry.names.index(DEFAULT_NORM))
+
 sdmt = st.sidebar.slider(
     min_value=0,
     max_value=100,
@@ -86,32 +103,39 @@ subject_DF = pd.DataFrame(subject_dict, index = [name])
 
 # Create z-scores distribution plot
 z_cutoff = -1.5
-fig, ax = plt.subplots()
-sns.kdeplot(ReferenceData().data, ax = ax, color= 'k', alpha =0.5)
+reference_density = get_reference_density()
+
+# Matplotlib is imported here and not at the top, so that the page starts rendering while it loads
+from matplotlib.figure import Figure
+fig = Figure()
+ax = fig.subplots()
+ax.plot(reference_density.z, reference_density.density, color= 'k', alpha =0.5)
 ax.spines['top'].set_visible(False)
 ax.spines['right'].set_visible(False)
 ax.spines['left'].set_visible(False)
 ax.get_yaxis().set_visible(False)
 ax.set_xlabel('Z Score')
 ax.set_xlim([-4,4])
-kde_x, kde_y = ax.lines[0].get_data()
-ax.fill_between(kde_x, kde_y, where= kde_x > -4, color='#b1eba9')  # First fill everything green
-ax.fill_between(kde_x, kde_y, where=kde_x <= z_cutoff,color='#EF9A9A')  # Then fill red only where necessary
+ax.set_ylim(bottom=0)
+ax.fill_between(reference_density.z, reference_density.density, color='#b1eba9')  # First fill everything green
+ax.fill_between(reference_density.z, reference_density.density,
+                where=reference_density.z <= z_cutoff, color='#EF9A9A')  # Then fill red only where necessary
 
 # Calculate z-scores and add to ax object
+subject_demographics = pd.DataFrame({'age': [age], 'sex': [sex_int], 'education': [edu_int], 'norm': [norm]})
+subject_raw_scores = pd.DataFrame({'sdmt': [sdmt], 'bvmt': [bvmt], 'cvlt': [cvlt]})
+subject_transformed = batch_normalization(demographics = subject_demographics,
+                                          raw_scores = subject_raw_scores,
+                                          z_cutoff = z_cutoff,
+                                          norm_registry = norm_registry)
 imp_dict = dict()
 z_dict = dict()
-for test, test_str, conv_table, colour,label_pos in zip([sdmt, bvmt, cvlt],
-                                                        ['sdmt', 'bvmt', 'cvlt'],
-                                                        [sdmt_conv_table, bvmt_conv_table, cvlt_conv_table],
-                                                        ['blue', 'black','purple'],
-                                                        [1,2,3]):
-
-            z_score, imp_bool = normalization_pipeline(data_vector = [age, age**2, sex_int, edu_int],
-                                               raw_score= test,
-                                               test = test_str,
-                                               conversion_table= conv_table,
-                                               z_cutoff= z_cutoff)
+for test_str, colour,label_pos in zip(['sdmt', 'bvmt', 'cvlt'],
+                                      ['blue', 'black','purple'],
+                                      [1,2,3]):
+
+            z_score = subject_transformed[test_str + '_z'].iloc[0]
+            imp_bool = subject_transformed[test_str + '_imp'].iloc[0]
 
             # Plot vertical line on x-position being z-score. Add vertical text alongside it.
             ax.axvline(x=z_score, color = colour)
@@ -119,7 +143,9 @@ for test, test_str, conv_table, colour,label_pos in zip([sdmt, bvmt, cvlt],
             ax.text(x=z_score+0.05, y= text_position, s=test_str, rotation =90, color = colour)
 
             # Update imp_dict and z_dict
-            if imp_bool == 0:
+            if np.isnan(z_score):
+                        text = f'not covered by the {norm} norm set'
+            elif imp_bool == 0:
                         text = 'preserved'
             else:
                         text = 'impaired'
@@ -127,9 +153,9 @@ for test, test_str, conv_table, colour,label_pos in zip([sdmt, bvmt, cvlt],
             z_dict.update({test_str: z_score})
 
 # Get z-score and text for impaired/preserved
-sdmt_z = round(z_dict.get('sdmt'), 2)
-bvmt_z = round(z_dict.get('bvmt'), 2)
-cvlt_z = round(z_dict.get('cvlt'), 2)
+sdmt_z = round(float(z_dict.get('sdmt')), 2)
+bvmt_z = round(float(z_dict.get('bvmt')), 2)
+cvlt_z = round(float(z_dict.get('cvlt')), 2)
 sdmt_imp = imp_dict.get('sdmt')
 bvmt_imp = imp_dict.get('bvmt')
 cvlt_imp = imp_dict.get('cvlt')
@@ -143,7 +169,8 @@ st.write(f'- SDMT: {sdmt}. Information Processing Speed is {sdmt_imp} (z-score =
 st.write(f'- BVMT: {bvmt}. Visual Learning and Memory is {bvmt_imp} (z-score = {bvmt_z})')
 st.write(f'- CVLT: {cvlt}. Verbal Learning and Memory is {cvlt_imp} (z-score = {cvlt_z})')
 st.subheader('Projection on z-scores disbribution')
-st.pyplot(fig)
+with measure('plot'):
+    st.pyplot(fig)
 show_disclaimer = st.button(label = 'Show disclaimer about impairment cut-off of z = -1.5')
 if show_disclaimer:
             st.write('*The sensitivity of this normalization method (correcting with regression-based norms from a healthy reference population) is higher '
@@ -171,7 +198,7 @@ st.title('Part 2: Convert your own data!')
 st.markdown('***')
 st.header('Step 1: Prepare your data')
 st.write('This is what your data should look like:')
-st.write(pd.read_excel("data/mock_data.xlsx").head())
+st.write(get_mock_preview())
 st.write('- *age* column: years (integer)')
 st.write('- *sex* column: 1 = Male, 2 = Female (integer)')
 st.write('- *education* column: years of education (integer). Choose from [6, 12, 13, 15, 17, 21]. '
@@ -181,122 +208,160 @@ st.write('**Note 1**: please use exactly these column names in this order')
 st.write('**Note 2**: only the 3 first columns are an absolute requirement. '
          'For the cognitive scores, please prepare your dataframe to only contain columns for which you have data. '
          'Hence, this can be a subset of the latter 3 columns, but should at least include one of them')
+st.write(f'**Note 3**: optionally, add a *norm* column with the norm set to use for every row, one of {norm_registry.names}. '
+         f'Without this column, every row uses {DEFAULT_NORM}')
 
 st.header('Step 2: Define the z-score on which you want to declare cognitive impairment')
+z_cutoff_options = [-1.5, -1, -0.5, 0]
 z_cutoff = st.selectbox(label = 'Choose the z cutoff score',
-                        options = [-1.5, -1, -0.5, 0])
+                        options = z_cutoff_options)
+add_all_cutoffs = st.checkbox(label = 'Also add impairment columns for every cutoff to compare them ("imp@<cutoff>")')
+export_format = st.selectbox(label = 'Choose the file format of your enriched file',
+                             options = get_export_formats())
+
+st.header('Step 3: Upload your file (excel, csv or parquet)')
+input_object = st.file_uploader("Browse for a file or drag and drop here:", type=("xlsx", "csv", "parquet"))
+
+# Table Conversion: every stage (parse + check, z-scores, impairment flags, export) is cached by the content hash of
+# the upload, so that changing the cutoff or any other widget does not re-read and re-convert the file. Large uploads
+# are converted by a background job instead, whose ID is kept in the URL so that the result survives a page refresh
+job_queue.resume_once()
+all_cutoffs = z_cutoff_options if add_all_cutoffs else ()
+job_id = st.text_input(label = 'Or enter the job ID of an earlier conversion of a large file',
+                       value = st.query_params.get('job', '')).strip()
+transformed_preview = pd.DataFrame()
+valid_data = pd.DataFrame()
+error_table = pd.DataFrame()
+
+
+def show_error_table(error_table):
+    """ Report the values that did not pass the checks; these rows are left out of the conversion """
+    st.warning(f"{error_table['row'].nunique()} rows contain invalid values and were skipped. "
+               f"Row numbers start at 0 for the first row below the column names.")
+    st.write(error_table.head(100))
+    st.download_button(label = 'Download the error report (csv)',
+                       data = error_table.to_csv(index = False),
+                       file_name = 'validation_errors.csv',
+                       mime = 'text/csv')
+
+
+def retry_job():
+    """ Start the failed background job of the current upload again on the next run """
+    st.session_state['retry_job'] = True
+
+
+@st.fragment(run_every = 1)
+def show_job_progress(job_id):
+    """ Poll the progress of a background job, and rerun the whole page once it has finished """
+    progress = job_queue.progress(job_id)
+    if progress['status'] in (DONE, FAILED):
+        st.rerun()
+    text = f"{progress['rows_done']} of {progress['total_rows'] or '?'} rows converted"
+    if progress['rows_per_second']:
+        text += f", {progress['rows_per_second']:.0f} rows/s"
+    if progress['eta_seconds'] is not None:
+        text += f", about {progress['eta_seconds']:.0f} s left"
+    st.progress(progress['fraction'], text = text)
+
 
-st.header('Step 3: Upload your excel file')
-input_object = st.file_uploader("Browse for a file or drag and drop here:", type=("xlsx"))
 if input_object:
-    input_data = pd.read_excel(input_object)
-
-    # region Perform checks if the data was correctly entered
-    error_dict = {'columns': 'Please be sure to use the correct column names and that they are lower case',
-                  'age': 'Please use age values between 0 and 125 years, and only use integer values',
-                  'sex': 'Please assure the following encoding: Male = 1, Female = 2',
-                  'education': 'Please use education levels that are encoded as 6, 12, 13, 15, 17 or 21 years',
-                  'sdmt': 'Please use sdmt values between 0 and 110',
-                  'bvmt': 'Please use bvmt values between 0 and 36',
-                  'cvlt': 'Please use cvlt values between 0 and 80'}
-
-    allowed_range_dict = {'columns': {'age', 'sex', 'education', 'sdmt', 'bvmt', 'cvlt'},
-                          'age': set(range(0, 126)),
-                          'sex': {1, 2},
-                          'education': {6, 12, 13, 15, 17, 21},
-                          'sdmt': set(range(0, 111)),
-                          'bvmt': set(range(0, 37)),
-                          'cvlt': set(range(0, 81))}
-
-    for key in ['columns'] + list(input_data.columns):
-        # Extract the data vector for a specific key
-        if key == 'columns':
-            input_vector = set(input_data.columns)
+    # The upload is only hashed once per uploaded file, not on every rerun
+    if st.session_state.get('upload_file_id') != input_object.file_id:
+        st.session_state['upload_hash'] = hashlib.sha256(input_object.getvalue()).hexdigest()
+        st.session_state['upload_file_id'] = input_object.file_id
+    upload_hash = st.session_state['upload_hash']
+    upload_bytes = input_object.getvalue()
+    if len(upload_bytes) > JOB_THRESHOLD_MB * 1e6:
+        job_id = job_queue.submit(upload_hash = upload_hash,
+                                  file_name = input_object.name,
+                                  upload_bytes = upload_bytes,
+                                  retry = st.session_state.pop('retry_job', False))
+        st.query_params['job'] = job_id
+    else:
+        job_id = ''
+        upload_pipeline = UploadPipeline(upload_hash = upload_hash,
+                                         file_name = input_object.name,
+                                         upload_bytes = upload_bytes,
+                                         norm_registry = norm_registry)
+        try:
+            with st.spinner('Converting your file...'):
+                valid_data, error_table = upload_pipeline.validated()
+                check_output_rows(len(valid_data), export_format)
+                transformed_preview = upload_pipeline.preview(z_cutoff, all_cutoffs)
+                # The file is only written when the download button is clicked, and cached from then on
+                export_data = functools.partial(upload_pipeline.export, z_cutoff, export_format, all_cutoffs)
+                cohort_summary = upload_pipeline.summary(z_cutoff, z_cutoff_options)
+                prevalence = cohort_summary.prevalence()
+        except ValueError as error:
+            st.error(str(error))
         else:
-            input_vector = set(input_data[key])
-        # Check whether the vector is within the allowed range
-        if not input_vector.issubset(allowed_range_dict.get(key)):
-            raise ValueError(error_dict.get(key))
-
-    # endregion
-
-else:
-    input_data = pd.DataFrame()
-
-# Table Conversion
-if input_data.empty == False:
-
-    # Print preview of the data
-    st.write('Your input data (first 5 rows):')
-    st.write(input_data)
-
-    # Add age^2 column for the calculation
-    age_2 = input_data['age'] ** 2
-    input_data.insert(loc=1, column='age^2', value=age_2)  # insert age^2 column in second position (thus loc = 1)
-
-    # Load the data (either mock data or your data)
-    demographics = input_data[['age', 'age^2', 'sex', 'education']]
-    cognitive_raw = input_data.drop(['age', 'age^2', 'sex', 'education'], axis=1)
-
-    # Load the conversion tables
-    conversion_table_dict = {'sdmt': ConversionTable().sdmt,
-                             'bvmt': ConversionTable().bvmt,
-                             'cvlt': ConversionTable().cvlt}
-
-    # region Calculate all z-scores and binary scores (impaired / preserved) for all tests and all subjects
-    # General initiations
-    transform_matrix = []
-
-    for subject in range(input_data.shape[0]):
-
-        # Initiations per subject
-        z_row = []
-        imp_row = []
-
-        for test in cognitive_raw.columns:
-
-            # Extract raw data from dataframe
-            raw_scores = cognitive_raw[test]
-
-            # Get correct conversion table
-            conv_table = conversion_table_dict.get(test)
-
-            # Calculate z-score and whether it is impaired or not for the test and subject
-            z_score, imp_bool = normalization_pipeline(data_vector = demographics.iloc[subject],
-                                                       raw_score= raw_scores.iloc[subject],
-                                                       test = test,
-                                                       conversion_table= conv_table,
-                                                       z_cutoff= z_cutoff)
-
-            # Append lists
-            z_row.append(z_score)
-            imp_row.append(imp_bool)
-
-        # Append to general matrix
-        transform_matrix.append(z_row + imp_row)
-
-    # endregion
-
-    # region Put in matrix
-    # Define new columnnames for dataframe
-    z_score_columns = [element + '_z' for element in cognitive_raw.columns]
-    imp_columns = [element + '_imp' for element in cognitive_raw.columns]
-    new_columns = z_score_columns + imp_columns
-
-    # Convert matrix to pandas dataframe
-    transform_matrix = pd.DataFrame(data=transform_matrix,
-                                    columns=new_columns)
-    # endregion
-
-    # Concatenate original data with the z-scores and impairment boolean columns
-    transformed_data = pd.concat([input_data, transform_matrix], axis = 1)
+            if not error_table.empty:
+                show_error_table(error_table)
+
+            # Print preview of the data
+            if valid_data.empty == False:
+                st.write(f'Your input data (first 5 of {len(valid_data)} valid rows):')
+                st.write(valid_data.head())
+
+if job_id:
+    progress = job_queue.progress(job_id)
+    if progress is None:
+        st.error(f'No conversion found for job ID {job_id}')
+    else:
+        st.write(f'Your file is converted in the background. Use this job ID to fetch the result later, '
+                 f'also after closing this page: `{job_id}`')
+        if progress['status'] == FAILED:
+            st.error(progress['error'])
+            if input_object:
+                st.button(label = 'Retry the conversion', on_click = retry_job)
+        elif progress['status'] == DONE:
+            # The job stores the z-scores only, the cutoff and format are applied to them here
+            job_result = job_queue.result(job_id)
+            if not job_result['error_table'].empty:
+                show_error_table(job_result['error_table'])
+            st.write(f"Converted {job_result['rows']} valid rows.")
+            try:
+                check_output_rows(job_result['rows'], export_format)
+            except ValueError as error:
+                st.error(str(error))
+            else:
+                transformed_preview = job_queue.preview(job_id, z_cutoff, all_cutoffs)
+                export_data = functools.partial(job_queue.export, job_id, z_cutoff, export_format, all_cutoffs)
+                cohort_summary = job_queue.summary(job_id, z_cutoff, z_cutoff_options)
+                prevalence = cohort_summary.prevalence()
+        else:
+            show_job_progress(job_id)
 
 st.header('Step 4: Download your file, enriched with new information!')
-if input_data.empty == False:
+if transformed_preview.empty == False:
     st.write('A little sneak peak:')
-    st.write(transformed_data.head())
-    st.write('Fetch your excel file below!')
-    st.markdown(get_table_download_link(transformed_data), unsafe_allow_html=True)
+    st.write(transformed_preview)
+    st.subheader('Cohort summary')
+    st.write('Mean and standard deviation of the z-scores:')
+    st.write(cohort_summary.overall().round(2))
+    st.write('Percentage of impaired subjects for every z cutoff:')
+    st.write(prevalence.round(1))
+    breakdown_column = st.selectbox(label = 'Break down the z-scores by',
+                                    options = GROUP_COLUMNS)
+    st.write(f'z-scores per {breakdown_column}, with the percentage of impaired subjects at z = {cohort_summary.z_cutoff}:')
+    st.write(cohort_summary.breakdown(breakdown_column).round(2))
+
+    # Histograms of the z-scores, drawn from the binned counts of the summary
+    fig = Figure(figsize = (4 * len(cohort_summary.tests), 3))
+    axes = fig.subplots(1, len(cohort_summary.tests), squeeze = False)
+    for ax, test_str, counts in zip(axes[0], cohort_summary.tests, cohort_summary.histogram):
+        ax.bar(HISTOGRAM_EDGES[:-1], counts, width = np.diff(HISTOGRAM_EDGES), align = 'edge', color = '#b1eba9')
+        ax.axvline(x = cohort_summary.z_cutoff, color = '#EF9A9A')
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.set_title(test_str)
+        ax.set_xlabel('Z Score')
+    st.pyplot(fig)
+    st.write('Fetch your file below!')
+    st.download_button(label = f'Download {export_format} file',
+                       data = export_data,
+                       file_name = f'transformed_data.{export_format}',
+                       mime = EXPORT_FORMATS.get(export_format))
     st.write('**Note**')
     st.write('- In the "imp" columns, 0 denotes preserved, 1 denotes impaired')
     st.write('- age^2 was added which is the age column squared. This is necessary to calculate the z-scores.') 
@@ -325,3 +390,11 @@ st.write('This project aims to provide insight in studying cognitive performance
          'a fellow PhD student at the AIMS lab.')
 st.write('I am happy to get in touch! Just send a mail to <stijn.denissen@vub.be> :wink:')
 st.markdown('[twitter](https://twitter.com/denissenstijn) - [LinkedIn](https://www.linkedin.com/in/stijndenissen/) - [github](https://github.com/Sdniss)')
+
+# Debug panel with the metrics of this process, if BICAMS_METRICS and BICAMS_METRICS_PANEL are set
+if METRICS_PANEL:
+    st.sidebar.subheader('Metrics')
+    metrics_summary = pd.DataFrame(metrics_registry.summary())
+    if metrics_summary.empty == False:
+        metrics_summary['peak MB'] = metrics_summary.pop('peak_bytes') / 1e6
+        st.sidebar.dataframe(metrics_summary.set_index('stage').round(4))
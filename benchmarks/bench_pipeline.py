@@ -0,0 +1,173 @@
+""" Benchmark of the conversion pipeline, with a regression gate against a stored baseline
+
+Synthetic cohorts shaped like data/mock_data.xlsx are written to a temporary directory and pushed through every stage of
+the pipeline: load, validate, expected scores, raw-to-scaled lookup, normalize and export. Every stage reports its
+median wall time, throughput and peak traced memory.
+
+Usage:
+    python benchmarks/bench_pipeline.py                       # 1k, 100k and 1M rows
+    python benchmarks/bench_pipeline.py --sizes 1000 100000 --save-baseline
+    python benchmarks/bench_pipeline.py --sizes 1000 100000 --compare --threshold 0.25
+
+With --compare, the exit code is 1 when a stage is more than threshold (relative) slower than the baseline.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from export import export_chunks
+from functions import batch_normalization, get_expected_scores, raw_to_scaled
+from ingest import read_chunks
+from norms import get_norm_registry
+from validation import allowed_category_dict, allowed_range_dict, validate
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+TESTS = ['sdmt', 'bvmt', 'cvlt']
+
+# Slowdowns smaller than this are timer noise, whatever their relative size
+MIN_DELTA_SECONDS = 0.002
+
+
+def make_cohort(n_rows, seed=0):
+    """ Synthetic cohort with the columns of data/mock_data.xlsx and values within the allowed ranges """
+    rng = np.random.default_rng(seed)
+    cohort = {'age': rng.integers(18, 90, n_rows)}
+    for column in ['sex', 'education']:
+        cohort[column] = rng.choice(allowed_category_dict.get(column), n_rows)
+    for column in TESTS:
+        lower, upper = allowed_range_dict.get(column)
+        cohort[column] = rng.integers(lower, upper + 1, n_rows)
+    return pd.DataFrame(cohort)
+
+
+def measure(function, repeats):
+    """ Median wall time over repeats and peak traced memory of one extra traced run
+
+    :return: seconds: float -- peak_bytes: int -- result: return value of the last call
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+
+    # Memory is traced in a separate run, as tracing slows down the allocations that are being timed
+    tracemalloc.start()
+    function()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return float(np.median(timings)), peak_bytes, result
+
+
+def run_benchmarks(sizes, input_format, export_format, repeats):
+    """ Time every stage of the pipeline for every cohort size
+
+    :return: dict mapping '<stage>@<rows>' to a dict with seconds, rows_per_second and peak_mb
+    """
+    norm_registry = get_norm_registry()
+    results = dict()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for n_rows in sizes:
+            cohort = make_cohort(n_rows)
+            input_path = os.path.join(temp_dir, f'cohort_{n_rows}.{input_format}')
+            if input_format == 'xlsx':
+                cohort.to_excel(input_path, index=False)
+            elif input_format == 'parquet':
+                cohort.to_parquet(input_path, index=False)
+            else:
+                cohort.to_csv(input_path, index=False)
+
+            demographics = cohort[['age', 'sex', 'education']]
+            normalized = batch_normalization(demographics, cohort[TESTS], -1.5)
+            transformed = pd.concat([cohort, normalized], axis=1)
+
+            stages = {'load': lambda: pd.concat(list(read_chunks(input_path))),
+                      'validate': lambda: validate(cohort),
+                      'expected_scores': lambda: get_expected_scores(cohort['age'], cohort['sex'],
+                                                                     cohort['education'], TESTS),
+                      'raw_to_scaled': lambda: [raw_to_scaled(cohort[test].to_numpy(),
+                                                              norm_registry.lookup[0, norm_registry.test_index(test)])
+                                                for test in TESTS],
+                      'normalize': lambda: batch_normalization(demographics, cohort[TESTS], -1.5),
+                      'export': lambda: export_chunks([transformed], export_format)}
+
+            for stage, function in stages.items():
+                # Slow stages on large cohorts are timed once
+                stage_repeats = repeats if n_rows <= 100000 or stage not in ('load', 'export') else 1
+                seconds, peak_bytes, _ = measure(function, stage_repeats)
+                results[f'{stage}@{n_rows}'] = {'seconds': seconds,
+                                                'rows_per_second': n_rows / seconds if seconds > 0 else float('inf'),
+                                                'peak_mb': peak_bytes / 1e6}
+                print(f'{stage:>16} {n_rows:>9} rows: {seconds * 1000:10.1f} ms '
+                      f'{n_rows / seconds:14.0f} rows/s {peak_bytes / 1e6:9.1f} MB peak', flush=True)
+
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """ Stages that are more than threshold (relative) and MIN_DELTA_SECONDS (absolute) slower than in the baseline
+
+    :return: list of str, one description per regression
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        slowdown = result['seconds'] / baseline[key]['seconds'] - 1
+        if slowdown > threshold and result['seconds'] - baseline[key]['seconds'] > MIN_DELTA_SECONDS:
+            regressions.append(f"{key}: {baseline[key]['seconds'] * 1000:.1f} ms -> "
+                               f"{result['seconds'] * 1000:.1f} ms ({slowdown:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help='number of rows of the synthetic cohorts (default: 1000 100000 1000000)')
+    parser.add_argument('--input-format', choices=['csv', 'xlsx', 'parquet'], default='csv',
+                        help='format of the synthetic input files (default: csv)')
+    parser.add_argument('--export-format', choices=['csv', 'xlsx', 'parquet'], default='xlsx',
+                        help='format of the export stage (default: xlsx)')
+    parser.add_argument('--repeats', type=int, default=3, help='number of timed runs per stage (default: 3)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help=f'baseline file (default: {BASELINE_FILE})')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='compare the results to the baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='relative slowdown that counts as a regression (default: 0.25)')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.input_format, args.export_format, args.repeats)
+
+    exit_code = 0
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f'No baseline found at {args.baseline}, run with --save-baseline first')
+            exit_code = 2
+        else:
+            with open(args.baseline) as baseline_file:
+                regressions = compare_to_baseline(results, json.load(baseline_file), args.threshold)
+            for regression in regressions:
+                print(f'REGRESSION {regression}')
+            if regressions:
+                exit_code = 1
+            else:
+                print(f'No stage is more than {args.threshold:.0%} slower than the baseline')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
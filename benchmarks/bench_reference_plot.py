@@ -0,0 +1,81 @@
+""" Benchmark of the z-score distribution plot of Part 1
+
+Compares the render time of the former plot (seaborn kdeplot over the 100.000 reference samples, whose curve is read
+back to shade the impaired region) with the current plot (precomputed density curve, shaded directly).
+
+Usage: python benchmarks/bench_reference_plot.py [--repeats 10]
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from load_data import get_reference_density
+
+
+def load_reference_samples():
+    """ 100.000 standard normal samples, like the reference array the former plot was drawn from """
+    return np.random.default_rng(0).standard_normal(100000)
+
+
+def render_kdeplot(samples, z_cutoff):
+    import seaborn as sns
+    fig, ax = plt.subplots()
+    sns.kdeplot(samples, ax=ax, color='k', alpha=0.5)
+    ax.set_xlim([-4, 4])
+    kde_x, kde_y = ax.lines[0].get_data()
+    ax.fill_between(kde_x, kde_y, where=kde_x > -4, color='#b1eba9')
+    ax.fill_between(kde_x, kde_y, where=kde_x <= z_cutoff, color='#EF9A9A')
+    fig.canvas.draw()
+    plt.close(fig)
+
+
+def render_precomputed(z_cutoff):
+    reference_density = get_reference_density()
+    fig, ax = plt.subplots()
+    ax.plot(reference_density.z, reference_density.density, color='k', alpha=0.5)
+    ax.set_xlim([-4, 4])
+    ax.set_ylim(bottom=0)
+    ax.fill_between(reference_density.z, reference_density.density, color='#b1eba9')
+    ax.fill_between(reference_density.z, reference_density.density,
+                    where=reference_density.z <= z_cutoff, color='#EF9A9A')
+    fig.canvas.draw()
+    plt.close(fig)
+
+
+def time_it(function, repeats):
+    """ Median wall time in seconds of repeated calls to function """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeats', type=int, default=10, help='number of renders per variant')
+    args = parser.parse_args()
+
+    samples = load_reference_samples()
+    z_cutoff = -1.5
+
+    # Warm up imports and caches so that only the rendering itself is timed
+    render_kdeplot(samples, z_cutoff)
+    render_precomputed(z_cutoff)
+
+    before = time_it(lambda: render_kdeplot(samples, z_cutoff), args.repeats)
+    after = time_it(lambda: render_precomputed(z_cutoff), args.repeats)
+    print(f'seaborn kdeplot on {len(samples)} samples: {before * 1000:.1f} ms')
+    print(f'precomputed density curve:            {after * 1000:.1f} ms')
+    print(f'speed-up: {before / after:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
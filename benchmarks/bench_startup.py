@@ -0,0 +1,129 @@
+""" Benchmark of the cold start of the application: import time and the cost of the first render
+
+Every measurement runs in a fresh Python process, like a new container: the modules imported by the application are
+timed one by one, then the page is rendered twice with streamlit's AppTest (first render on a cold process, then a
+rerun on the same process).
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --save-baseline
+    python benchmarks/bench_startup.py --compare --threshold 0.25
+
+With --compare, the exit code is 1 when a stage is more than threshold (relative) slower than the baseline.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+from bench_pipeline import compare_to_baseline
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_baseline.json')
+APP_FILE = os.path.join(ROOT_DIR, 'BICAMS_application.py')
+
+# Modules imported at the top of the application, in order, followed by the ones it imports lazily
+APP_MODULES = ['streamlit', 'pandas', 'numpy', 'load_data', 'norms', 'functions', 'export', 'pipeline', 'jobs',
+               'summary', 'metrics', 'prewarm']
+LAZY_MODULES = ['matplotlib.figure', 'matplotlib.pyplot']
+
+# Modules that should not be loaded to render the page without an upload (streamlit itself loads pyarrow, and
+# matplotlib.pyplot in st.pyplot)
+HEAVY_MODULES = ['openpyxl', 'seaborn', 'xlsxwriter']
+
+CHILD_SCRIPT = '''
+import json, sys, time
+sys.path.insert(0, {root!r})
+stage = {stage!r}
+results = dict()
+if stage == 'import':
+    for module in {modules!r}:
+        start = time.perf_counter()
+        __import__(module)
+        results['import_' + module] = time.perf_counter() - start
+else:
+    from streamlit.testing.v1 import AppTest
+    app = AppTest.from_file({app!r}, default_timeout=120)
+    start = time.perf_counter()
+    app.run()
+    results['first_render'] = time.perf_counter() - start
+    start = time.perf_counter()
+    app.run()
+    results['rerun'] = time.perf_counter() - start
+    results['heavy_modules'] = [module for module in {heavy!r} if module in sys.modules]
+print(json.dumps(results))
+'''
+
+
+def run_child(stage):
+    """ Run one measurement in a fresh Python process
+
+    :param stage: str, 'import' or 'render'
+    :return: dict mapping a stage name to seconds
+    """
+    script = CHILD_SCRIPT.format(root=ROOT_DIR, stage=stage, modules=APP_MODULES + LAZY_MODULES, app=APP_FILE,
+                                 heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', script], cwd=ROOT_DIR, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def run_benchmarks(repeats):
+    """ Median of every startup stage over repeats fresh processes
+
+    :return: dict mapping a stage to a dict with seconds -- list of heavy modules loaded by the first render
+    """
+    timings = dict()
+    heavy_modules = set()
+    for _ in range(repeats):
+        for stage in ['import', 'render']:
+            child_results = run_child(stage)
+            heavy_modules.update(child_results.pop('heavy_modules', []))
+            for key, seconds in child_results.items():
+                timings.setdefault(key, []).append(seconds)
+
+    results = {key: {'seconds': float(np.median(values))} for key, values in timings.items()}
+    for key, result in results.items():
+        print(f"{key:>28}: {result['seconds'] * 1000:10.1f} ms", flush=True)
+    return results, sorted(heavy_modules)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeats', type=int, default=3, help='number of fresh processes per stage (default: 3)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help=f'baseline file (default: {BASELINE_FILE})')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='compare the results to the baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='relative slowdown that counts as a regression (default: 0.25)')
+    args = parser.parse_args()
+
+    results, heavy_modules = run_benchmarks(args.repeats)
+    if heavy_modules:
+        print(f'Heavy modules loaded by the first render: {heavy_modules}')
+
+    exit_code = 0
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f'No baseline found at {args.baseline}, run with --save-baseline first')
+            exit_code = 2
+        else:
+            with open(args.baseline) as baseline_file:
+                regressions = compare_to_baseline(results, json.load(baseline_file), args.threshold)
+            for regression in regressions:
+                print(f'REGRESSION {regression}')
+            if regressions:
+                exit_code = 1
+            else:
+                print(f'No stage is more than {args.threshold:.0%} slower than the baseline')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
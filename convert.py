@@ -0,0 +1,191 @@
+""" Convert raw BICAMS scores to z-scores without the web application
+
+Library use:
+    from convert import convert_file, convert_files
+    result = convert_file('cohort.xlsx', 'cohort_z.xlsx', z_cutoff=-1.5)
+
+Command line use:
+    python convert.py cohort.xlsx -o cohort_z.xlsx --z-cutoff -1.5
+    python convert.py cohort.xlsx -o cohort_z.csv --z-cutoff -1.5 -1 -0.5 0
+    python convert.py 'exports/*.csv' -o converted/ --format csv --workers 4
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from ingest import CHUNK_SIZE, FILE_FORMATS, convert_stream
+
+
+def convert_file(input_path, output_path, z_cutoff=-1.5, chunksize=CHUNK_SIZE):
+    """ Convert one input file to an enriched output file with z-scores and impairment columns
+
+    Rows that do not pass validation are skipped and written to '<output name>_errors.csv' next to the output.
+
+    :param input_path: str, path to an xlsx, csv or parquet file with the input data
+    :param output_path: str, path of the xlsx, csv or parquet file to write
+    :param z_cutoff: float, the value where you want to declare impairment on the cognitive domain, or a list of them
+    :param chunksize: int, maximum number of rows held in memory at once
+    :return: dict with the input and output paths, the number of converted and invalid rows, seconds, rows per second and
+             error (None)
+    """
+    start = time.perf_counter()
+    rows, error_table = convert_stream(source=input_path,
+                                       output=output_path,
+                                       z_cutoff=z_cutoff,
+                                       chunksize=chunksize)
+    if not error_table.empty:
+        error_table.to_csv(get_error_path(output_path), index=False)
+    seconds = time.perf_counter() - start
+
+    return {'input': input_path,
+            'output': output_path,
+            'rows': rows,
+            'invalid_rows': error_table['row'].nunique(),
+            'seconds': seconds,
+            'rows_per_second': rows / seconds if seconds > 0 else float('inf'),
+            'error': None}
+
+
+def get_failed_result(input_path, output_path, error):
+    """ Result of a file that could not be converted, with the same keys as the result of convert_file """
+    return {'input': input_path,
+            'output': output_path,
+            'rows': 0,
+            'invalid_rows': 0,
+            'seconds': 0.0,
+            'rows_per_second': 0.0,
+            'error': f'{type(error).__name__}: {error}'}
+
+
+def convert_files(input_paths, output_dir, z_cutoff=-1.5, output_format='xlsx', workers=None, chunksize=CHUNK_SIZE):
+    """ Convert several input files in parallel over a pool of processes
+
+    :param input_paths: list of str, paths to xlsx, csv or parquet files
+    :param output_dir: str, directory to write '<input name>_z.<output_format>' files to
+    :param z_cutoff: float, the value where you want to declare impairment on the cognitive domain, or a list of them
+    :param output_format: str, 'xlsx', 'csv' or 'parquet'
+    :param workers: int, number of processes. Defaults to the number of CPUs
+    :param chunksize: int, maximum number of rows held in memory at once per process
+    :return: list of dicts, the results of convert_file in the order of input_paths. A file that could not be converted
+             does not stop the others, its result holds the exception in 'error'
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    output_paths = get_output_paths(input_paths, output_dir, output_format)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convert_file, input_path, output_path, z_cutoff, chunksize)
+                   for input_path, output_path in zip(input_paths, output_paths)]
+        results = []
+        for input_path, output_path, future in zip(input_paths, output_paths, futures):
+            try:
+                results.append(future.result())
+            except Exception as error:
+                results.append(get_failed_result(input_path, output_path, error))
+        return results
+
+
+def get_output_paths(input_paths, output_dir, output_format):
+    """ Output path of every input file: '<input name>_z.<output_format>' in output_dir
+
+    Input files with the same name but another extension, e.g. a.csv and a.xlsx, get the extension in their output
+    name instead ('a_csv_z.<output_format>' and 'a_xlsx_z.<output_format>').
+
+    :return: list of str paths, in the order of input_paths
+    """
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in input_paths]
+    names = [f'{stem}_{os.path.splitext(path)[1].lower().lstrip(".")}' if stems.count(stem) > 1 else stem
+             for stem, path in zip(stems, input_paths)]
+    output_paths = [os.path.join(output_dir, f'{name}_z.{output_format}') for name in names]
+    duplicates = sorted({path for path in output_paths if output_paths.count(path) > 1})
+    if duplicates:
+        raise ValueError(f'Several input files would be written to {duplicates}, please rename them')
+    return output_paths
+
+
+def get_error_path(output_path):
+    """ Path of the validation error report that belongs to an output file """
+    return f'{os.path.splitext(output_path)[0]}_errors.csv'
+
+
+def find_input_files(pattern, output_dir=None):
+    """ Expand a directory or glob pattern to the supported input files it contains
+
+    :param pattern: str, path to a file or directory, or a glob pattern
+    :param output_dir: str, directory the converted files are written to. Earlier outputs and error reports in it
+                       ('*_z.*' and '*_errors.csv') are left out
+    :return: sorted list of str paths
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*')
+    return sorted(path for path in glob.glob(pattern)
+                  if os.path.isfile(path) and os.path.splitext(path)[1].lower() in FILE_FORMATS
+                  and not (output_dir is not None and is_output_file(path, output_dir)))
+
+
+def is_output_file(path, output_dir):
+    """ Whether a file in output_dir is a converted file or error report written by convert_files """
+    if os.path.abspath(os.path.dirname(path)) != os.path.abspath(output_dir):
+        return False
+    stem, extension = os.path.splitext(os.path.basename(path))
+    return stem.endswith('_z') or (stem.endswith('_errors') and extension.lower() == '.csv')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert raw BICAMS scores (sdmt, bvmt, cvlt) to z-scores')
+    parser.add_argument('input', help='input file, directory or glob pattern (xlsx, csv or parquet)')
+    parser.add_argument('-o', '--output', required=True,
+                        help='output file for a single input file, output directory otherwise')
+    parser.add_argument('--z-cutoff', type=float, nargs='+', default=[-1.5],
+                        help='z-score at or below which a cognitive domain is declared impaired (default: -1.5). '
+                             'With several cutoffs, one "<test>_imp@<cutoff>" column is added per test and cutoff')
+    parser.add_argument('--format', choices=sorted(FILE_FORMATS.values()), default='xlsx',
+                        help='output format when converting several files (default: xlsx)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes when converting several files (default: number of CPUs)')
+    parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE,
+                        help=f'number of rows held in memory at once (default: {CHUNK_SIZE})')
+    args = parser.parse_args(argv)
+    z_cutoff = args.z_cutoff[0] if len(args.z_cutoff) == 1 else args.z_cutoff
+
+    start = time.perf_counter()
+    if os.path.isfile(args.input):
+        try:
+            results = [convert_file(args.input, args.output, z_cutoff, args.chunksize)]
+        except Exception as error:
+            results = [get_failed_result(args.input, args.output, error)]
+    else:
+        input_paths = find_input_files(args.input, output_dir=args.output)
+        if not input_paths:
+            parser.error(f'no xlsx, csv or parquet files found for "{args.input}"')
+        try:
+            results = convert_files(input_paths, args.output, z_cutoff, args.format, args.workers, args.chunksize)
+        except ValueError as error:
+            parser.error(str(error))
+
+    for result in results:
+        if result['error'] is not None:
+            print(f"{result['input']} -> {result['output']}: FAILED, {result['error']}")
+            continue
+        message = (f"{result['input']} -> {result['output']}: {result['rows']} rows in {result['seconds']:.2f} s "
+                   f"({result['rows_per_second']:.0f} rows/s)")
+        if result['invalid_rows']:
+            message += f", {result['invalid_rows']} invalid rows skipped (see {get_error_path(result['output'])})"
+        print(message)
+
+    if len(results) > 1:
+        total_rows = sum(result['rows'] for result in results)
+        total_seconds = time.perf_counter() - start
+        print(f'Total: {total_rows} rows in {len(results)} files in {total_seconds:.2f} s '
+              f'({total_rows / total_seconds:.0f} rows/s)')
+
+    failed = [result for result in results if result['error'] is not None]
+    if failed:
+        print(f'{len(failed)} of {len(results)} files could not be converted')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,37 @@
+from importlib.util import find_spec
+from io import BytesIO
+from ingest import ChunkWriter
+from metrics import measure
+
+# MIME type of every export format, used for the download response
+EXPORT_FORMATS = {'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                  'csv': 'text/csv',
+                  'parquet': 'application/vnd.apache.parquet'}
+
+
+def get_export_formats():
+    """ Export formats that can be written in this environment
+
+    :return: list of str, parquet is only included when pyarrow is installed
+    """
+    # Look pyarrow up without importing it, it is only imported when a parquet file is written
+    if find_spec('pyarrow') is None:
+        return ['xlsx', 'csv']
+    return ['xlsx', 'csv', 'parquet']
+
+
+def export_chunks(chunks, file_format):
+    """ Write chunks of a dataframe to the bytes of a single file
+
+    :param chunks: iterable of pd dataframes
+    :param file_format: str, 'xlsx', 'csv' or 'parquet'
+    :return: bytes of the file
+    """
+    output = BytesIO()
+    with measure(f'export_{file_format}') as measurement:
+        with ChunkWriter(output, file_format=file_format) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+        measurement.rows = writer.rows
+    return output.getvalue()
+
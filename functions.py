@@ -1,111 +1,152 @@
 import numpy as np
 import pandas as pd
-import base64
-from io import BytesIO
+from load_data import OUT_OF_RANGE
+from metrics import timed
+from norms import DEFAULT_NORM, MAX_AGE, MAX_EDUCATION, MAX_SEX, get_norm_registry
 
 
-def normalization_pipeline(data_vector, raw_score, test, conversion_table, z_cutoff):
-    """ Entire normalization pipeline
+def batch_normalization(demographics, raw_scores, z_cutoff, norm_registry=None):
+    """ Vectorized normalization pipeline for all subjects and all tests at once
 
-    :param data_vector: 1-D vector consisting in following order: [age, age^2, sex, education]
-    :param raw_score: int, raw score on the test of interest
-    :param test: str, choose from 'sdmt', 'bvmt' or 'cvlt'
-    :param conversion_table: pd dataframe, being the conversion table for the test of interest
-    :param z_cutoff: float, the value where you want to declare impairment on the cognitive domain
-    :returns: z_score: z-score for the test of interest -- impaired_bool: 1 if impaired, 0 if preserved
+    :param demographics: pd dataframe with the columns 'age', 'sex' and 'education' (one row per subject), and
+                         optionally 'norm' with the name of the norm set of every subject
+    :param raw_scores: pd dataframe with one column of raw scores per test ('sdmt', 'bvmt' and/or 'cvlt')
+    :param z_cutoff: float, the value where you want to declare impairment on the cognitive domain. Can also be a list
+                     of cutoffs, in which case the impairment columns are named '<test>_imp@<cutoff>'
+    :param norm_registry: NormRegistry with the norm sets, defaults to the norm sets in data/norms
+    :returns: pd dataframe with the '<test>_z' columns followed by the '<test>_imp' columns
     """
 
-    expected_score = get_expected_score(data_vector, test)
-    scaled_score = raw_to_scaled(raw_score, conversion_table)
-    z_score = to_z_score(scaled_score, expected_score, test)
-    impaired_bool = impaired_or_not(z_score, z_cutoff)
+    z_scores = batch_z_scores(demographics, raw_scores, norm_registry)
+    if np.ndim(z_cutoff) == 0:
+        impaired = batch_impaired_or_not(z_scores, z_cutoff)
+    else:
+        impaired = batch_impairment_matrix(z_scores, z_cutoff)
 
-    return z_score, impaired_bool
+    return pd.concat([z_scores, impaired], axis=1)
 
 
-def get_expected_score(data_vector, test):
-    """ Get the expected score on a subtest of the BICAMS
+@timed('z_scores')
+def batch_z_scores(demographics, raw_scores, norm_registry=None):
+    """ Vectorized z-scores for all subjects and all tests at once
 
-    :param data_vector: 1-D vector consisting in following order: [age, age^2, sex, education]
-    :param test: str, choose from 'sdmt', 'bvmt' or 'cvlt'
-    :return: the expected score on the respective test
+    :param demographics: pd dataframe with the columns 'age', 'sex' and 'education' (one row per subject), and
+                         optionally 'norm' with the name of the norm set of every subject (default: DEFAULT_NORM)
+    :param raw_scores: pd dataframe with one column of raw scores per test ('sdmt', 'bvmt' and/or 'cvlt')
+    :param norm_registry: NormRegistry with the norm sets, defaults to the norm sets in data/norms
+    :returns: pd dataframe with one float32 '<test>_z' column per test, backed by a single 2-D array
     """
-    weight_dict = {'sdmt': [10.648, -0.289, 0.002, -0.05, 0.479],
-                   'cvlt': [9.052, -0.230, 0.002, 2.182, 0.323],
-                   'bvmt': [16.902, -0.473, 0.005, -1.427, 0.341]}
 
-    weight_vector = weight_dict.get(test)
-    data_vector = [1] + list(data_vector)  # Add 1 to multiply with bias term in regression equation
-    expected_score = np.dot(weight_vector, data_vector)
+    norm_registry = norm_registry or get_norm_registry()
+    tests = list(raw_scores.columns)
+    test_indices = [norm_registry.test_index(test) for test in tests]
 
-    return expected_score
+    # One norm set for all subjects, or one per subject
+    if 'norm' in demographics:
+        norm_index = norm_registry.norm_index(demographics['norm'].to_numpy())
+    else:
+        norm_index = norm_registry.norm_index([DEFAULT_NORM])[0]
 
+    expected_scores = get_expected_scores(age = demographics['age'].to_numpy(),
+                                          sex = demographics['sex'].to_numpy(),
+                                          education = demographics['education'].to_numpy(),
+                                          tests = tests,
+                                          norm_index = norm_index,
+                                          norm_registry = norm_registry)
 
-def raw_to_scaled(raw_score, conversion_table):
-    """ Convert raw score to a categorical, scaled value
+    # z-scores are written test by test into one preallocated block, that the dataframe uses without a copy
+    denominators = norm_registry.residual_sd[norm_index][..., test_indices]
+    z_scores = np.empty((len(raw_scores), len(tests)), dtype=np.float32)
+    for column, (test, test_index) in enumerate(zip(tests, test_indices)):
+        scaled_scores = raw_to_scaled(raw_scores[test].to_numpy(), norm_registry.lookup[:, test_index], norm_index)
+        z_scores[:, column] = (scaled_scores - expected_scores[:, column]) / denominators[..., column]
 
-    :param raw_score: int, raw score on the test of interest
-    :param conversion_table: pd dataframe, being the conversion table for the test of interest
-    :return: categorical, scaled score
-    """
+    return pd.DataFrame(z_scores, columns=[test + '_z' for test in tests], index=raw_scores.index, copy=False)
 
-    scaled_scores = conversion_table.iloc[:,0]
-    lower_values = conversion_table.iloc[:,1]
-    upper_values = conversion_table.iloc[:,2]
 
-    for scaled_score, lower_value, upper_value in zip(scaled_scores, lower_values, upper_values):
-        if lower_value <= raw_score <= upper_value:
-            return scaled_score
+def batch_impaired_or_not(z_scores, cutoff):
+    """ Dichotimize the '<test>_z' columns of batch_z_scores by applying a cutoff
 
+    :param z_scores: pd dataframe with '<test>_z' columns
+    :param cutoff: the cut-off to decide impaired (<=) or preserved (>) on the cognitive domain
+    :return: pd dataframe with one uint8 '<test>_imp' column per test: 1 if impaired, 0 if preserved
+    """
+    # One bool block, viewed as uint8 so that the files keep 0/1 values
+    impaired = (z_scores.to_numpy() <= cutoff).view(np.uint8)
+    imp_columns = [column[:-len('_z')] + '_imp' for column in z_scores.columns]
 
-def to_z_score(scaled_score, expected_score, test):
-    """ Turn scaled and expected score to a z score
+    return pd.DataFrame(impaired, columns=imp_columns, index=z_scores.index, copy=False)
 
-    :param scaled_score: scaled score, result from raw_to_scaled function
-    :param expected_score: expected score, result from get_expected_score function
-    :param test: test of interest
-    :return: z-score for the test of interest
-    """
-    denominator_dict = {'sdmt': 2.790,
-                        'bvmt': 2.793,
-                        'cvlt': 2.801}
 
-    denominator = denominator_dict.get(test)
+def batch_impairment_matrix(z_scores, cutoffs):
+    """ Dichotimize the '<test>_z' columns of batch_z_scores for several cutoffs in a single pass
 
-    z_score = (scaled_score - expected_score)/denominator
+    :param z_scores: pd dataframe with '<test>_z' columns
+    :param cutoffs: list of cut-offs to decide impaired (<=) or preserved (>) on the cognitive domain
+    :return: pd dataframe with a uint8 '<test>_imp@<cutoff>' column per test and cutoff: 1 if impaired, 0 if preserved
+    """
+    cutoffs = np.asarray(cutoffs, dtype=np.float64)
+    tests = [column[:-len('_z')] for column in z_scores.columns]
 
-    return z_score
+    # (subjects, tests, cutoffs) in one broadcast comparison, flattened to one column per test and cutoff
+    impaired = (z_scores.to_numpy()[:, :, np.newaxis] <= cutoffs).view(np.uint8)
+    imp_columns = [f'{test}_imp@{cutoff:g}' for test in tests for cutoff in cutoffs]
 
+    return pd.DataFrame(impaired.reshape(len(z_scores), len(imp_columns)), columns=imp_columns, index=z_scores.index,
+                        copy=False)
 
-def impaired_or_not(z_score, cutoff):
-    """ Dichotimize z-score by applying a cutoff
 
-    :param z_score: the z-score, i.e. performance relative to a reference population
-    :param cutoff: the cut-off to decide impaired (<=) or preserved (>) on the cognitive domain
-    :return: 1 if impaired, 0 if preserved
-    """
-    if z_score <= cutoff:
-        return 1
-    else:
-        return 0
+def get_expected_scores(age, sex, education, tests, norm_index=0, norm_registry=None):
+    """ Get the expected scores of many subjects on several subtests of the BICAMS
 
+    :param age: 1-D array, age in years of every subject
+    :param sex: 1-D array, sex of every subject (1 = Male, 2 = Female)
+    :param education: 1-D array, education level in years of every subject
+    :param tests: list of str, tests from 'sdmt', 'bvmt' and 'cvlt'
+    :param norm_index: int, index of the norm set of all subjects, or 1-D int array with the norm set of every subject
+    :param norm_registry: NormRegistry with the norm sets, defaults to the norm sets in data/norms
+    :return: 2-D array with one row per subject and one column per test
+    """
+    norm_registry = norm_registry or get_norm_registry()
+    test_indices = [norm_registry.test_index(test) for test in tests]
+    age, sex, education = (np.asarray(vector) for vector in (age, sex, education))
+
+    # Demographics on the integer grid are read from the precomputed tables, integer arrays are used as index as-is
+    on_grid = all(np.all((vector >= 0) & (vector <= maximum)) and
+                  (np.issubdtype(vector.dtype, np.integer) or np.all(vector % 1 == 0))
+                  for vector, maximum in ((age, MAX_AGE), (sex, MAX_SEX), (education, MAX_EDUCATION)))
+    if on_grid:
+        index = (age.astype(np.intp), sex.astype(np.intp), education.astype(np.intp))
+        return np.column_stack([norm_registry.expected_scores[(norm_index, test_index) + index]
+                                for test_index in test_indices])
+
+    # Otherwise, evaluate the regression with design matrix [1, age, age^2, sex, education]
+    age, sex, education = (vector.astype(np.float64) for vector in (age, sex, education))
+    design_matrix = np.column_stack([np.ones_like(age), age, age ** 2, sex, education])
+    return np.column_stack([np.sum(design_matrix * norm_registry.weights[norm_index, test_index], axis=-1)
+                            for test_index in test_indices])
+
+
+def raw_to_scaled(raw_score, lookup_table, norm_index=None):
+    """ Convert raw score(s) to a categorical, scaled value
+
+    :param raw_score: int or 1-D array of ints, raw score(s) on the test of interest
+    :param lookup_table: 1-D array, compiled conversion table for the test of interest (see load_data.compile_lookup),
+                         or 2-D array with one compiled conversion table per norm set (see NormRegistry.lookup)
+    :param norm_index: int or 1-D int array, the norm set of every raw score. Only used with a 2-D lookup_table
+    :return: float or 1-D float array of scaled scores, NaN where the raw score falls outside the table
+    """
 
-# source to_excel and get_table_download_link: https://discuss.streamlit.io/t/how-to-download-file-in-streamlit/1806/2
-def to_excel(df):
-    output = BytesIO()
-    writer = pd.ExcelWriter(output, engine='xlsxwriter')
-    df.to_excel(writer, sheet_name='Sheet1')
-    writer.save()
-    processed_data = output.getvalue()
-    return processed_data
+    raw_score = np.asarray(raw_score)
+    if not np.issubdtype(raw_score.dtype, np.integer):
+        raw_score = raw_score.astype(np.float64)
 
+    # Non-integer, negative or too high raw scores do not map to any entry of the table
+    in_range = (raw_score >= 0) & (raw_score < lookup_table.shape[-1])
+    if raw_score.dtype.kind == 'f':
+        in_range &= raw_score % 1 == 0
+    index = np.where(in_range, raw_score, 0).astype(np.intp)
+    scaled_score = lookup_table[index] if lookup_table.ndim == 1 else lookup_table[norm_index, index]
+    scaled_score = np.where(in_range & (scaled_score != OUT_OF_RANGE), scaled_score, np.nan)
 
-def get_table_download_link(df):
-    """Generates a link allowing the data in a given panda dataframe to be downloaded
-    in:  dataframe
-    out: href string
-    """
-    val = to_excel(df)
-    b64 = base64.b64encode(val)  # val looks like b'...'
-    return f'<a href="data:application/octet-stream;base64,{b64.decode()}" ' \
-           f'download="transformed_data.xlsx">Download excel file</a>'  # decode b'abc' => abc
+    return scaled_score[()] if scaled_score.ndim == 0 else scaled_score
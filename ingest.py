@@ -0,0 +1,299 @@
+import io
+import os
+from itertools import islice
+import numpy as np
+import pandas as pd
+from functions import batch_normalization
+from metrics import measure
+from validation import validate, get_test_columns, ERROR_TABLE_COLUMNS
+
+# Number of rows that is read, validated, normalized and written at once
+CHUNK_SIZE = 50000
+
+# Supported file formats, derived from the file extension
+FILE_FORMATS = {'.xlsx': 'xlsx', '.csv': 'csv', '.parquet': 'parquet'}
+
+# Rows of an Excel sheet, including the row with the column names
+XLSX_MAX_ROWS = 1048576
+
+def get_file_format(source):
+    """ Derive the file format from the name of a path or uploaded file
+
+    :param source: str path or file-like object with a name attribute
+    :return: str, 'xlsx', 'csv' or 'parquet'
+    """
+    name = source if isinstance(source, (str, os.PathLike)) else getattr(source, 'name', '')
+    extension = os.path.splitext(str(name))[1].lower()
+    if extension not in FILE_FORMATS:
+        raise ValueError(f'Unsupported file type "{extension}", please use one of {sorted(FILE_FORMATS)}')
+    return FILE_FORMATS.get(extension)
+
+
+def read_chunks(source, file_format=None, chunksize=CHUNK_SIZE):
+    """ Read an input file in chunks of rows, so that memory use does not depend on the file size
+
+    :param source: str path or file-like object (e.g. a Streamlit upload)
+    :param file_format: str, 'xlsx', 'csv' or 'parquet'. Derived from the file name if None
+    :param chunksize: int, maximum number of rows per chunk
+    :return: generator of pd dataframes, indexed by the row number in the input file
+    """
+    file_format = file_format or get_file_format(source)
+    if file_format == 'xlsx':
+        chunks = _read_xlsx_chunks(source, chunksize)
+    elif file_format == 'csv':
+        chunks = pd.read_csv(source, chunksize=chunksize)
+    elif file_format == 'parquet':
+        chunks = _read_parquet_chunks(source, chunksize)
+    else:
+        raise ValueError(f'Unsupported file format "{file_format}"')
+
+    # Number the rows over the whole file instead of per chunk
+    chunks = iter(chunks)
+    start = 0
+    while True:
+        with measure(f'read_{file_format}') as measurement:
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            measurement.rows = len(chunk)
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        start += len(chunk)
+        yield chunk
+
+
+def count_rows(source, file_format=None):
+    """ Number of data rows of an input file, without parsing its values
+
+    For csv files, this is the number of lines below the header, so blank lines are counted as well.
+
+    :param source: str path or seekable binary file-like object
+    :param file_format: str, 'xlsx', 'csv' or 'parquet'. Derived from the file name if None
+    :return: int, or None if the number of rows is not stored in the file
+    """
+    file_format = file_format or get_file_format(source)
+    if file_format == 'xlsx':
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(source, read_only=True)
+        try:
+            max_row = workbook.active.max_row
+        finally:
+            workbook.close()
+        return None if max_row is None else max(max_row - 1, 0)
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        return pq.ParquetFile(source).metadata.num_rows
+
+    handle = open(source, 'rb') if isinstance(source, (str, os.PathLike)) else source
+    try:
+        lines = 0
+        last_block = b''
+        for block in iter(lambda: handle.read(1 << 20), b''):
+            lines += block.count(b'\n')
+            last_block = block
+        if last_block and not last_block.endswith(b'\n'):
+            lines += 1
+    finally:
+        if handle is not source:
+            handle.close()
+        else:
+            handle.seek(0)
+    return max(lines - 1, 0)
+
+
+def _read_xlsx_chunks(source, chunksize):
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        # Skip the empty rows that Excel often keeps at the end of a sheet
+        rows = (row for row in rows if any(value is not None for value in row))
+        while True:
+            batch = list(islice(rows, chunksize))
+            if not batch:
+                break
+            yield pd.DataFrame.from_records(batch, columns=header)
+    finally:
+        workbook.close()
+
+
+def _read_parquet_chunks(source, chunksize):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Reading parquet files requires pyarrow, install it with "pip install pyarrow"')
+
+    for batch in pq.ParquetFile(source).iter_batches(batch_size=chunksize):
+        yield batch.to_pandas()
+
+
+def normalize_chunks(chunks, z_cutoff, norm_registry=None):
+    """ Validate and normalize chunks of input data, skipping the rows that did not pass validation
+
+    :param chunks: iterable of pd dataframes with the input data
+    :param z_cutoff: float, the value where you want to declare impairment on the cognitive domain, or a list of them
+    :param norm_registry: NormRegistry to normalize with. Defaults to the norm sets in data/norms
+    :return: generator of (transformed_chunk, error_table) tuples. transformed_chunk holds the valid rows with the input
+             data, age^2 and the '<test>_z' and '<test>_imp' columns, error_table is the result of validation.validate
+    """
+    for chunk in chunks:
+        chunk, error_table = validate(chunk, norm_registry)
+
+        cognitive_raw = chunk[get_test_columns(chunk.columns, norm_registry)]
+        transform_matrix = batch_normalization(demographics=chunk,
+                                               raw_scores=cognitive_raw,
+                                               z_cutoff=z_cutoff,
+                                               norm_registry=norm_registry)
+
+        yield assemble_output(chunk, [transform_matrix]), error_table
+
+
+def assemble_output(valid_data, blocks):
+    """ Lay out the enriched data: the input columns with age^2 in second position, like the original conversion
+    output, followed by the columns of the blocks
+
+    age^2 is only computed here, and the columns of valid_data and the blocks are used without copying them.
+
+    :param valid_data: pd dataframe with the valid input data, see validation.validate
+    :param blocks: list of pd dataframes with the same index, e.g. the z-scores and the impairment flags
+    :return: pd dataframe
+    """
+    age_squared = (valid_data['age'].astype(np.uint16) ** 2).rename('age^2')
+    return pd.concat([valid_data.iloc[:, :1], age_squared, valid_data.iloc[:, 1:], *blocks], axis=1)
+
+
+def check_output_rows(rows, file_format):
+    """ Raise a ValueError if a file of file_format cannot hold this many rows (below the column names) """
+    if file_format == 'xlsx' and rows > XLSX_MAX_ROWS - 1:
+        raise ValueError(f'An xlsx file holds at most {XLSX_MAX_ROWS - 1} rows, '
+                         f'please choose csv or parquet for this file')
+
+
+def _xlsx_values(column):
+    """ Cell values of a pd series. float32 values are written at float32 precision, like the csv and parquet files """
+    if column.dtype == np.float32:
+        # The shortest repr of a float32, so -0.9770609 is not widened to -0.9770609140396118
+        return column.to_numpy().astype(str).astype(np.float64).tolist()
+    return column.tolist()
+
+
+class ChunkWriter:
+    """ Write chunks of a dataframe to a single output file, one chunk at a time
+
+    Use as a context manager: the output is finalized when the block is left.
+    """
+
+    def __init__(self, output, file_format=None):
+        """
+        :param output: str path or binary file-like object to write to
+        :param file_format: str, 'xlsx', 'csv' or 'parquet'. Derived from the file name if None
+        """
+        self.output = output
+        self.file_format = file_format or get_file_format(output)
+        self.rows = 0
+        self._writer = None
+        self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        # Do not leave a truncated file behind when writing failed
+        if exc_type is not None and isinstance(self.output, (str, os.PathLike)) and os.path.exists(self.output):
+            os.remove(self.output)
+
+    def write(self, chunk):
+        """ Append a pd dataframe to the output """
+        if self._writer is None:
+            self._open(chunk)
+        if self.file_format == 'xlsx':
+            # xlsxwriter skips rows past the end of the sheet without raising
+            check_output_rows(self.rows + len(chunk), self.file_format)
+            columns = [_xlsx_values(chunk[column]) for column in chunk.columns]
+            for offset, row in enumerate(zip(*columns)):
+                self._writer.write_row(self.rows + offset + 1, 0, row)
+        elif self.file_format == 'csv':
+            chunk.to_csv(self._writer, header=self.rows == 0, index=False)
+        else:
+            import pyarrow as pa
+            self._writer.write_table(pa.Table.from_pandas(chunk, schema=self._writer.schema, preserve_index=False))
+        self.rows += len(chunk)
+
+    def _open(self, chunk):
+        if self.file_format == 'xlsx':
+            import xlsxwriter
+            # constant_memory flushes every row to disk once the next row is started
+            self._handle = xlsxwriter.Workbook(self.output, {'constant_memory': True, 'nan_inf_to_errors': True})
+            self._writer = self._handle.add_worksheet('Sheet1')
+            self._writer.write_row(0, 0, [str(column) for column in chunk.columns])
+        elif self.file_format == 'csv':
+            if isinstance(self.output, (str, os.PathLike)):
+                self._handle = open(self.output, 'w', newline='')
+            else:
+                self._handle = io.TextIOWrapper(self.output, newline='', write_through=True)
+            self._writer = self._handle
+        elif self.file_format == 'parquet':
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError('Writing parquet files requires pyarrow, install it with "pip install pyarrow"')
+            schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+            self._writer = pq.ParquetWriter(self.output, schema)
+            self._handle = self._writer
+        else:
+            raise ValueError(f'Unsupported file format "{self.file_format}"')
+
+    def close(self):
+        if self._handle is None:
+            return
+        if self.file_format == 'csv' and not isinstance(self.output, (str, os.PathLike)):
+            # Leave the caller's binary stream open
+            self._handle.flush()
+            self._handle.detach()
+        else:
+            self._handle.close()
+        self._handle = None
+
+
+def convert_stream(source, output, z_cutoff, input_format=None, output_format=None, chunksize=CHUNK_SIZE,
+                   norm_registry=None):
+    """ Read, validate, normalize and write an input file chunk by chunk
+
+    :param source: str path or file-like object with the input data
+    :param output: str path or binary file-like object to write the enriched data to
+    :param z_cutoff: float, the value where you want to declare impairment on the cognitive domain, or a list of them
+    :param input_format: str, format of the input. Derived from the file name if None
+    :param output_format: str, format of the output. Derived from the file name if None
+    :param chunksize: int, maximum number of rows held in memory at once
+    :param norm_registry: NormRegistry to normalize with. Defaults to the norm sets in data/norms
+    :return: rows: int, number of converted rows -- error_table: pd dataframe with the values that did not pass validation
+    """
+    input_format = input_format or get_file_format(source)
+    output_format = output_format or get_file_format(output)
+
+    # Fail before converting anything if the input has more rows than the output format holds
+    if output_format == 'xlsx':
+        check_output_rows(count_rows(source, input_format) or 0, output_format)
+
+    chunks = read_chunks(source, file_format=input_format, chunksize=chunksize)
+    error_tables = []
+    with ChunkWriter(output, file_format=output_format) as writer:
+        for transformed_chunk, error_table in normalize_chunks(chunks, z_cutoff, norm_registry):
+            writer.write(transformed_chunk)
+            if not error_table.empty:
+                error_tables.append(error_table)
+    return writer.rows, concat_error_tables(error_tables)
+
+
+def concat_error_tables(error_tables):
+    """ Combine the error tables of several chunks into one """
+    if not error_tables:
+        return pd.DataFrame(columns=ERROR_TABLE_COLUMNS)
+    return pd.concat(error_tables, ignore_index=True)
@@ -0,0 +1,330 @@
+""" Background conversion of large uploads, with an on-disk job store
+
+Every job is a directory in JOBS_DIR named after its job ID:
+
+    job.json            status and progress of the job
+    input.<format>      the uploaded file
+    chunks/<n>.pkl      (valid input data, z-scores, error table) of every converted chunk
+    errors.csv          the values that did not pass validation
+    exports/<key>.<f>   the enriched files, written on request for every cutoff and format
+
+A job only reads, validates and normalizes the upload. Everything that depends on the cutoff or the export format (the
+impairment flags, the preview, the summary and the enriched files) is derived from the stored chunks, so changing these
+parameters never converts the upload again. Converted chunks are stored as soon as they are done, so a job that was
+interrupted by a restart resumes at the first missing chunk. The job ID is derived from the upload, so uploading the
+same file again returns the existing job.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from export import export_chunks
+from functions import batch_impaired_or_not, batch_impairment_matrix, batch_z_scores
+from ingest import CHUNK_SIZE, assemble_output, check_output_rows, concat_error_tables, count_rows, read_chunks
+from load_data import ROOT_DIR
+from pipeline import result_cache
+from summary import CohortSummary
+from validation import get_test_columns, validate
+
+JOBS_DIR = os.environ.get('BICAMS_JOBS_DIR', os.path.join(ROOT_DIR, 'jobs'))
+
+# Uploads larger than this are converted by a background job instead of in the script thread
+JOB_THRESHOLD_MB = float(os.environ.get('BICAMS_JOB_THRESHOLD_MB', 5))
+
+# Number of jobs that run at the same time
+JOB_WORKERS = int(os.environ.get('BICAMS_JOB_WORKERS', 2))
+
+# Finished and failed jobs are removed after this many hours
+JOB_TTL_HOURS = float(os.environ.get('BICAMS_JOB_TTL_HOURS', 24))
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+PREVIEW_ROWS = 5
+
+
+def get_job_id(upload_hash):
+    """ Job ID of an upload
+
+    :param upload_hash: str, hash of the uploaded bytes, e.g. sha256
+    :return: str of 32 hexadecimal characters
+    """
+    return hashlib.sha256(upload_hash.encode()).hexdigest()[:32]
+
+
+def get_export_key(z_cutoff, all_cutoffs=()):
+    """ Name of the enriched file of a job for the given parameters """
+    key = json.dumps([z_cutoff, list(all_cutoffs)])
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def transform_chunk(valid_chunk, z_scores, z_cutoff, all_cutoffs=()):
+    """ Enriched data of a stored chunk: the valid input data with age^2, the '<test>_z' and '<test>_imp' columns,
+    followed by the '<test>_imp@<cutoff>' columns of all_cutoffs """
+    blocks = [z_scores, batch_impaired_or_not(z_scores, z_cutoff)]
+    if all_cutoffs:
+        blocks.append(batch_impairment_matrix(z_scores, all_cutoffs))
+    return assemble_output(valid_chunk, blocks)
+
+
+class JobQueue:
+    """ Pool of worker threads that convert uploads in the background and keep their state in a job store on disk """
+
+    def __init__(self, jobs_dir=JOBS_DIR, workers=JOB_WORKERS, chunksize=CHUNK_SIZE):
+        self.jobs_dir = jobs_dir
+        self.workers = workers
+        self.chunksize = chunksize
+        self._executor = None
+        self._active = set()
+        self._lock = threading.Lock()
+        self._submit_lock = threading.Lock()
+        self._resumed = False
+
+    def submit(self, upload_hash, file_name, upload_bytes, retry=False):
+        """ Start converting an upload in the background, unless it was converted, failed or is running already
+
+        :param upload_hash: str, hash of the uploaded bytes, e.g. sha256
+        :param file_name: str, name of the uploaded file, used to derive its format
+        :param upload_bytes: bytes of the uploaded file
+        :param retry: bool, start a failed conversion again. Without it, a failed job is kept with its error
+        :return: str, the job ID
+        """
+        job_id = get_job_id(upload_hash)
+
+        # Sessions that submit the same upload at the same time must not remove each other's job directory
+        with self._submit_lock:
+            job = self.get(job_id)
+            if job is None or (retry and job['status'] == FAILED):
+                job_dir = self._job_dir(job_id)
+                shutil.rmtree(job_dir, ignore_errors=True)
+                os.makedirs(os.path.join(job_dir, 'chunks'))
+                input_format = os.path.splitext(file_name)[1].lower().lstrip('.')
+                with open(os.path.join(job_dir, f'input.{input_format}'), 'wb') as input_file:
+                    input_file.write(upload_bytes)
+                job = {'job_id': job_id,
+                       'file_name': file_name,
+                       'input_format': input_format,
+                       'status': QUEUED,
+                       'created': time.time(),
+                       'total_rows': None,
+                       'rows_done': 0}
+                self._write_job(job)
+        if job['status'] in (QUEUED, RUNNING):
+            self._start(job_id)
+        return job_id
+
+    def get(self, job_id):
+        """ State of a job, a dict read from its job.json, or None if there is no such job """
+        if not re.fullmatch('[0-9a-f]{32}', str(job_id)):
+            return None
+        try:
+            with open(os.path.join(self._job_dir(job_id), 'job.json')) as job_file:
+                return json.load(job_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def progress(self, job_id):
+        """ Progress of a job
+
+        :return: dict with the status, rows_done, total_rows, the fraction done, rows_per_second and eta_seconds (None
+                 while unknown), or None if there is no such job
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        rows_per_second = eta_seconds = None
+        run_seconds = time.time() - job.get('run_started', time.time())
+        run_rows = job['rows_done'] - job.get('run_rows', 0)
+        if job['status'] == RUNNING and run_seconds > 0 and run_rows > 0:
+            rows_per_second = run_rows / run_seconds
+            if job['total_rows'] is not None:
+                eta_seconds = max(job['total_rows'] - job['rows_done'], 0) / rows_per_second
+        if job['status'] == DONE:
+            fraction = 1.0
+        elif job['total_rows']:
+            fraction = min(job['rows_done'] / job['total_rows'], 1.0)
+        else:
+            fraction = 0.0
+        return {'status': job['status'], 'rows_done': job['rows_done'], 'total_rows': job['total_rows'],
+                'fraction': fraction, 'rows_per_second': rows_per_second, 'eta_seconds': eta_seconds,
+                'error': job.get('error')}
+
+    def result(self, job_id):
+        """ Result of a finished job, cached per process
+
+        :return: dict with the number of valid 'rows', the 'tests' and the 'error_table', or None if the job is not done
+        """
+        job = self.get(job_id)
+        if job is None or job['status'] != DONE:
+            return None
+        return result_cache.get(('job', job_id, 'result'),
+                                lambda: {'rows': job['valid_rows'],
+                                         'tests': job['tests'],
+                                         'error_table': pd.read_csv(os.path.join(self._job_dir(job_id), 'errors.csv'))})
+
+    def preview(self, job_id, z_cutoff, all_cutoffs=()):
+        """ The first rows of the enriched data of a finished job, cached per process """
+        return result_cache.get(('job', job_id, 'preview', z_cutoff, tuple(all_cutoffs)),
+                                lambda: self._preview(job_id, z_cutoff, all_cutoffs))
+
+    def _preview(self, job_id, z_cutoff, all_cutoffs):
+        chunk_paths = self._chunk_paths(job_id)
+        if not chunk_paths:
+            return pd.DataFrame()
+        valid_chunk, z_scores, _ = pd.read_pickle(chunk_paths[0])
+        return transform_chunk(valid_chunk.head(PREVIEW_ROWS), z_scores.head(PREVIEW_ROWS), z_cutoff, all_cutoffs)
+
+    def summary(self, job_id, z_cutoff, cutoffs=()):
+        """ CohortSummary of the z-scores of a finished job, computed from the stored chunks and cached per process """
+        return result_cache.get(('job', job_id, 'summary', z_cutoff, tuple(cutoffs)),
+                                lambda: self._summary(job_id, z_cutoff, cutoffs))
+
+    def _summary(self, job_id, z_cutoff, cutoffs):
+        cohort_summary = CohortSummary(self.result(job_id)['tests'], z_cutoff, cutoffs)
+        for chunk_path in self._chunk_paths(job_id):
+            valid_chunk, z_scores, _ = pd.read_pickle(chunk_path)
+            cohort_summary.update(pd.concat([valid_chunk, z_scores], axis=1))
+        return cohort_summary
+
+    def export(self, job_id, z_cutoff, export_format, all_cutoffs=()):
+        """ Bytes of the enriched file of a finished job, written from the stored chunks on the first request
+
+        :param export_format: str, 'xlsx', 'csv' or 'parquet'
+        :param all_cutoffs: list of cutoffs to add '<test>_imp@<cutoff>' columns for
+        """
+        check_output_rows(self.result(job_id)['rows'], export_format)
+        export_dir = os.path.join(self._job_dir(job_id), 'exports')
+        export_path = os.path.join(export_dir, f'{get_export_key(z_cutoff, all_cutoffs)}.{export_format}')
+        if not os.path.exists(export_path):
+            os.makedirs(export_dir, exist_ok=True)
+            chunks = (transform_chunk(valid_chunk, z_scores, z_cutoff, all_cutoffs)
+                      for valid_chunk, z_scores, _ in map(pd.read_pickle, self._chunk_paths(job_id)))
+            _write_bytes(export_chunks(chunks, export_format), export_path)
+        with open(export_path, 'rb') as export_file:
+            return export_file.read()
+
+    def resume(self):
+        """ Restart the jobs that were queued or running when the process stopped, and remove expired jobs
+
+        :return: list of str, the IDs of the restarted jobs
+        """
+        if not os.path.isdir(self.jobs_dir):
+            return []
+        resumed = []
+        for job_id in sorted(os.listdir(self.jobs_dir)):
+            job = self.get(job_id)
+            if job is None:
+                continue
+            if job['status'] in (QUEUED, RUNNING):
+                if self._start(job_id):
+                    resumed.append(job_id)
+            elif time.time() - job.get('updated', job['created']) > JOB_TTL_HOURS * 3600:
+                shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
+        return resumed
+
+    def resume_once(self):
+        """ resume, the first time it is called in this process """
+        with self._submit_lock:
+            if self._resumed:
+                return []
+            self._resumed = True
+            return self.resume()
+
+    def _start(self, job_id):
+        with self._lock:
+            if job_id in self._active:
+                return False
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bicams-job')
+            self._active.add(job_id)
+            self._executor.submit(self._run, job_id)
+            return True
+
+    def _run(self, job_id):
+        job = self.get(job_id)
+        try:
+            self._convert(job)
+        except Exception as error:
+            job.update(status=FAILED, error=str(error))
+            self._write_job(job)
+        finally:
+            with self._lock:
+                self._active.discard(job_id)
+
+    def _convert(self, job):
+        job_dir = self._job_dir(job['job_id'])
+        input_path = os.path.join(job_dir, f"input.{job['input_format']}")
+        chunk_dir = os.path.join(job_dir, 'chunks')
+
+        if job['total_rows'] is None:
+            job['total_rows'] = count_rows(input_path)
+
+        # Chunks that were stored before a restart are not converted again
+        rows_done = 0
+        job.update(status=RUNNING, run_started=time.time(), run_rows=0, rows_done=0)
+        self._write_job(job)
+        for index, chunk in enumerate(read_chunks(input_path, chunksize=self.chunksize)):
+            chunk_path = os.path.join(chunk_dir, f'{index:05d}.pkl')
+            if os.path.exists(chunk_path):
+                job['run_rows'] = rows_done + len(chunk)
+            else:
+                valid_chunk, error_table = validate(chunk)
+                z_scores = batch_z_scores(demographics=valid_chunk,
+                                          raw_scores=valid_chunk[get_test_columns(valid_chunk.columns)])
+                _write_pickle((valid_chunk, z_scores, error_table), chunk_path)
+            rows_done += len(chunk)
+            job['rows_done'] = rows_done
+            self._write_job(job)
+
+        self._finalize(job)
+        job.update(status=DONE, total_rows=rows_done, finished=time.time())
+        self._write_job(job)
+
+    def _finalize(self, job):
+        """ Write the error report and store the number of valid rows and the tests of the converted chunks """
+        valid_rows = 0
+        tests = []
+        error_tables = []
+        for chunk_path in self._chunk_paths(job['job_id']):
+            valid_chunk, z_scores, error_table = pd.read_pickle(chunk_path)
+            valid_rows += len(valid_chunk)
+            tests = tests or [column[:-len('_z')] for column in z_scores.columns]
+            if not error_table.empty:
+                error_tables.append(error_table)
+        concat_error_tables(error_tables).to_csv(os.path.join(self._job_dir(job['job_id']), 'errors.csv'), index=False)
+        job.update(valid_rows=valid_rows, tests=tests)
+
+    def _chunk_paths(self, job_id):
+        chunk_dir = os.path.join(self._job_dir(job_id), 'chunks')
+        return sorted(os.path.join(chunk_dir, name) for name in os.listdir(chunk_dir) if name.endswith('.pkl'))
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.jobs_dir, job_id)
+
+    def _write_job(self, job):
+        job['updated'] = time.time()
+        path = os.path.join(self._job_dir(job['job_id']), 'job.json')
+        with open(path + '.tmp', 'w') as job_file:
+            json.dump(job, job_file)
+        os.replace(path + '.tmp', path)
+
+
+def _write_pickle(value, path):
+    """ Write a pickle file atomically, so that an interrupted write never leaves a truncated file behind """
+    pd.to_pickle(value, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def _write_bytes(data, path):
+    """ Write a file atomically, also when several sessions write the same file at once """
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as output_file:
+        output_file.write(data)
+    os.replace(tmp_path, path)
+
+
+job_queue = JobQueue()
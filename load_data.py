@@ -1,29 +1,125 @@
+import os
+import threading
 import pandas as pd
 import numpy as np
+from metrics import measure
 
+# Location of the data files, independent of the working directory
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+MOCK_DATA_FILE = os.path.join(ROOT_DIR, 'data', 'mock_data.xlsx')
+
+# First rows of the mock data as csv, so that showing them does not need an Excel parse. Update with write_mock_preview
+MOCK_PREVIEW_FILE = os.path.join(ROOT_DIR, 'data', 'mock_preview.csv')
+MOCK_PREVIEW_ROWS = 5
+
+# Value in a compiled lookup table for raw scores that do not belong to any interval
+OUT_OF_RANGE = -1
+
+
+def compile_lookup(conversion_table):
+    """ Compile a conversion table to a dense array that maps every raw score to its scaled score
+
+    :param conversion_table: pd dataframe with the columns scaled_score, lower bound and upper bound
+    :return: 1-D int16 array where element i is the scaled score of raw score i
+    """
+
+    scaled_scores = conversion_table.iloc[:,0].to_numpy()
+    lower_values = conversion_table.iloc[:,1].to_numpy()
+    upper_values = conversion_table.iloc[:,2].to_numpy()
+
+    # Check the table before compiling it
+    if np.any(lower_values % 1 != 0) or np.any(upper_values % 1 != 0):
+        raise ValueError('Conversion table bounds should be integer raw scores')
+    lower_values = lower_values.astype(np.int64)
+    upper_values = upper_values.astype(np.int64)
+    if lower_values.min() < 0:
+        raise ValueError('Conversion table bounds should not be negative')
+    if np.any(lower_values > upper_values):
+        raise ValueError('Conversion table has an interval with lower bound > upper bound')
+    order = np.argsort(lower_values)
+    lower_values, upper_values, scaled_scores = lower_values[order], upper_values[order], scaled_scores[order]
+    if np.any(lower_values[1:] <= upper_values[:-1]):
+        raise ValueError('Conversion table has overlapping intervals')
+    if np.any(lower_values[1:] != upper_values[:-1] + 1):
+        raise ValueError('Conversion table has gaps between intervals')
+
+    lookup = np.full(upper_values.max() + 1, OUT_OF_RANGE, dtype=np.int16)
+    for scaled_score, lower_value, upper_value in zip(scaled_scores, lower_values, upper_values):
+        lookup[lower_value:upper_value + 1] = scaled_score
+
+    return lookup
+
+
+class ReferenceDensity:
 
-class ConversionTable:
     def __init__(self):
 
-        # Read relevant files
-        data_sdmt = pd.read_csv('data/sdmt_conversion_table.csv')
-        data_bvmt = pd.read_csv('data/bvmt_conversion_table.csv')
-        data_cvlt = pd.read_csv('data/cvlt_conversion_table.csv')
-        description = open('data_descriptions/conversion_table_description.txt')
+        # Density of the standard normal distribution of the reference population, on a fixed z grid
+        z_grid = np.linspace(-4, 4, 801)
+        density = np.exp(-0.5 * z_grid ** 2) / np.sqrt(2 * np.pi)
 
-        # Create the attributes
-        self.sdmt = data_sdmt
-        self.bvmt = data_bvmt
-        self.cvlt = data_cvlt
-        self.description = description.read()
+        self.z = z_grid
+        self.density = density
+        self.description = 'Standard normal density evaluated on 801 equally spaced z-scores between -4 and 4'
 
 
-class ReferenceData:
+class AssetCache:
+    """ Process-wide cache of loaded assets
+
+    Every asset is loaded once per process and reloaded when the modification time of one of its files changes.
+    """
 
     def __init__(self):
+        self._entries = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, paths, loader):
+        """ Get an asset from the cache, loading it if it is missing or outdated
+
+        :param key: str, name of the asset
+        :param paths: list of file paths the asset is loaded from
+        :param loader: callable without arguments that loads the asset
+        :return: the loaded asset
+        """
+        mtimes = tuple(os.path.getmtime(path) for path in paths)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == mtimes:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            with measure(f'load_{key}'):
+                asset = loader()
+            self._entries[key] = (mtimes, asset)
+            return asset
+
+    def stats(self):
+        """ Hit/miss counters and the names of the cached assets """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': sorted(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+asset_cache = AssetCache()
+
+
+def get_reference_density():
+    """ Cached ReferenceDensity, computed once per process """
+    return asset_cache.get('reference_density', [], ReferenceDensity)
+
+
+def get_mock_preview():
+    """ Cached first rows of the mock data, read from MOCK_PREVIEW_FILE """
+    return asset_cache.get('mock_preview', [MOCK_PREVIEW_FILE], lambda: pd.read_csv(MOCK_PREVIEW_FILE))
 
-        # read data
-        z_data = np.load('./data/z_score_array.npy')
 
-        self.data = z_data
-        self.description = 'Numpy array with 100.000 samples from a normal distribution with mean 0 and std 1'
+def write_mock_preview():
+    """ Write the first rows of MOCK_DATA_FILE to MOCK_PREVIEW_FILE, run this after changing the mock data """
+    pd.read_excel(MOCK_DATA_FILE).head(MOCK_PREVIEW_ROWS).to_csv(MOCK_PREVIEW_FILE, index=False)
@@ -0,0 +1,222 @@
+""" Timing, row count and memory metrics of the hot paths of the application
+
+Switched off by default. Set BICAMS_METRICS=1 to record, for every stage, the number of calls, the wall time, the
+number of rows and the peak memory traced by tracemalloc. Recorded metrics are kept in memory and can also be sent to:
+
+    BICAMS_METRICS_FILE=metrics.jsonl   one JSON line per measurement
+    BICAMS_METRICS_PORT=9108            Prometheus text format on http://localhost:9108/metrics
+
+and BICAMS_METRICS_PANEL=1 shows a summary table in the sidebar of the application.
+
+Usage:
+    @timed('validate')
+    def validate(input_data):
+        ...
+
+    with measure('export') as measurement:
+        ...
+        measurement.rows = len(data)
+
+When metrics are switched off, timed returns the function itself and measure returns a shared object that does
+nothing, so instrumented code runs as before or only pays for one function call.
+"""
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_ENABLED = os.environ.get('BICAMS_METRICS', '').lower() in ('1', 'true', 'yes', 'on')
+METRICS_FILE = os.environ.get('BICAMS_METRICS_FILE')
+METRICS_PORT = os.environ.get('BICAMS_METRICS_PORT')
+METRICS_PANEL = METRICS_ENABLED and os.environ.get('BICAMS_METRICS_PANEL', '').lower() in ('1', 'true', 'yes', 'on')
+
+
+class MetricsRegistry:
+    """ Totals per stage of all measurements of the process """
+
+    def __init__(self):
+        self.stages = dict()
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, rows=None, peak_bytes=None):
+        """ Add one measurement to the totals of its stage, and write it to METRICS_FILE if set """
+        with self._lock:
+            totals = self.stages.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'rows': 0, 'peak_bytes': 0,
+                                                    'last_seconds': 0.0})
+            totals['calls'] += 1
+            totals['seconds'] += seconds
+            totals['last_seconds'] = seconds
+            totals['rows'] += rows or 0
+            totals['peak_bytes'] = max(totals['peak_bytes'], peak_bytes or 0)
+            if METRICS_FILE:
+                with open(METRICS_FILE, 'a') as metrics_file:
+                    metrics_file.write(json.dumps({'time': time.time(), 'pid': os.getpid(), 'stage': stage,
+                                                   'seconds': seconds, 'rows': rows, 'peak_bytes': peak_bytes}) + '\n')
+
+    def summary(self):
+        """ Totals per stage, a list of dicts sorted by total time """
+        with self._lock:
+            rows = [{'stage': stage, **totals} for stage, totals in self.stages.items()]
+        return sorted(rows, key=lambda row: row['seconds'], reverse=True)
+
+    def to_prometheus(self):
+        """ Totals per stage in the Prometheus text exposition format """
+        metrics = [('bicams_stage_calls_total', 'counter', 'Number of measurements of the stage', 'calls'),
+                   ('bicams_stage_seconds_total', 'counter', 'Wall time spent in the stage', 'seconds'),
+                   ('bicams_stage_rows_total', 'counter', 'Number of rows processed by the stage', 'rows'),
+                   ('bicams_stage_peak_bytes', 'gauge', 'Largest peak memory traced during the stage', 'peak_bytes')]
+        summary = self.summary()
+        lines = []
+        for name, metric_type, description, field in metrics:
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for row in summary:
+                lines.append(f'{name}{{stage="{row["stage"]}"}} {row[field]}')
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self.stages.clear()
+
+
+class Measurement:
+    """ Context manager that records the wall time and traced peak memory of a stage
+
+    Measurements can be nested: the peak memory of an outer stage includes the peaks of the stages inside it. Memory is
+    traced for the whole process, so stages that run at the same time in other threads add to each other's peaks.
+    """
+
+    _local = threading.local()
+
+    def __init__(self, stage, rows=None):
+        self.stage = stage
+        self.rows = rows
+        self.seconds = None
+        self.peak_bytes = None
+
+    def __enter__(self):
+        stack = self._get_stack()
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        if stack:
+            # The peak is reset below, keep the peak of the enclosing stage so far
+            stack[-1]._peak = max(stack[-1]._peak, peak_bytes)
+        tracemalloc.reset_peak()
+        self._start_bytes = current_bytes
+        self._peak = current_bytes
+        stack.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self._start
+        stack = self._get_stack()
+        stack.pop()
+        peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+        if stack:
+            stack[-1]._peak = max(stack[-1]._peak, peak)
+        self.peak_bytes = peak - self._start_bytes
+        metrics_registry.record(self.stage, self.seconds, self.rows, self.peak_bytes)
+        return False
+
+    def _get_stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+
+class NullMeasurement:
+    """ Stand-in for Measurement when metrics are switched off """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_measurement = NullMeasurement()
+
+
+def measure(stage, rows=None):
+    """ Measure a stage in a with block
+
+    :param stage: str, name of the stage, e.g. 'validate'
+    :param rows: int, number of rows processed by the stage. Can also be set on the returned object inside the block
+    :return: context manager
+    """
+    if not METRICS_ENABLED:
+        return _null_measurement
+    return Measurement(stage, rows)
+
+
+def timed(stage):
+    """ Decorator that measures every call of a function as a stage
+
+    The number of rows is the length of the first argument, if it has one.
+
+    :param stage: str, name of the stage
+    """
+    def decorator(function):
+        if not METRICS_ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            first_argument = args[0] if args else next(iter(kwargs.values()), None)
+            rows = len(first_argument) if hasattr(first_argument, '__len__') else None
+            with Measurement(stage, rows):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics_registry.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server_lock = threading.Lock()
+_server = None
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """ Serve the metrics in the Prometheus text format on localhost, once per process
+
+    :param port: int or str, port to listen on. Nothing is started if None
+    :return: the running ThreadingHTTPServer, or None
+    """
+    global _server
+    if not METRICS_ENABLED or port is None:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer(('127.0.0.1', int(port)), _PrometheusHandler)
+            except OSError as error:
+                # E.g. another process already serves the metrics on this port, do not try again
+                warnings.warn(f'Metrics endpoint not started on port {port}: {error}')
+                _server = False
+                return None
+            threading.Thread(target=_server.serve_forever, name='bicams-metrics', daemon=True).start()
+    return _server or None
+
+
+metrics_registry = MetricsRegistry()
+
+if METRICS_ENABLED and not tracemalloc.is_tracing():
+    tracemalloc.start()
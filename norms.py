@@ -0,0 +1,122 @@
+import glob
+import os
+import numpy as np
+import pandas as pd
+from load_data import OUT_OF_RANGE, ROOT_DIR, asset_cache, compile_lookup
+
+NORMS_DIR = os.path.join(ROOT_DIR, 'data', 'norms')
+DEFAULT_NORM = 'costers2017'
+
+# Columns of a norm set file with the regression weights, in the order of the design matrix
+WEIGHT_COLUMNS = ['intercept', 'age', 'age^2', 'sex', 'education']
+
+# Demographic grid of the precomputed expected scores, indexed by value: age 0-125, sex 1-2, education 0-21 years
+MAX_AGE = 125
+MAX_SEX = 2
+MAX_EDUCATION = 21
+
+
+class NormSet:
+    def __init__(self, path):
+
+        # Read the norm set and the conversion tables it refers to
+        norm_table = pd.read_csv(path)
+        conversion_tables = [pd.read_csv(os.path.join(ROOT_DIR, 'data', file_name))
+                             for file_name in norm_table['conversion_table']]
+
+        # Create the attributes
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.tests = list(norm_table['test'])
+        self.weights = np.ascontiguousarray(norm_table[WEIGHT_COLUMNS].to_numpy(dtype=np.float64))
+        self.residual_sd = norm_table['residual_sd'].to_numpy(dtype=np.float64)
+        self.raw_score_range = {test: (int(min_raw), int(max_raw)) for test, min_raw, max_raw
+                                in zip(self.tests, norm_table['min_raw'], norm_table['max_raw'])}
+        self.lookup = {test: compile_lookup(conversion_table)
+                       for test, conversion_table in zip(self.tests, conversion_tables)}
+
+
+class NormRegistry:
+    """ All norm sets of the norms directory, compiled to contiguous arrays indexed by [norm, test, ...]
+
+    A test that is missing from a norm set has NaN weights, raw score range and an all OUT_OF_RANGE lookup table in that
+    norm set, so its z-scores come out as NaN. validation.validate reports these values as errors.
+    """
+
+    def __init__(self, norms_dir=NORMS_DIR):
+        paths = sorted(glob.glob(os.path.join(norms_dir, '*.csv')))
+        if not paths:
+            raise ValueError(f'No norm sets found in {norms_dir}')
+        norm_sets = [NormSet(path) for path in paths]
+
+        self.norm_sets = {norm_set.name: norm_set for norm_set in norm_sets}
+        self.names = list(self.norm_sets)
+        self.tests = list(dict.fromkeys(test for norm_set in norm_sets for test in norm_set.tests))
+
+        n_norms, n_tests = len(self.names), len(self.tests)
+        lookup_length = max(len(lookup) for norm_set in norm_sets for lookup in norm_set.lookup.values())
+        self.weights = np.full((n_norms, n_tests, len(WEIGHT_COLUMNS)), np.nan)
+        self.residual_sd = np.full((n_norms, n_tests), np.nan)
+        self.lookup = np.full((n_norms, n_tests, lookup_length), OUT_OF_RANGE, dtype=np.int16)
+        self.min_raw = np.full((n_norms, n_tests), np.nan)
+        self.max_raw = np.full((n_norms, n_tests), np.nan)
+        for norm_index, norm_set in enumerate(norm_sets):
+            for row, test in enumerate(norm_set.tests):
+                test_index = self.tests.index(test)
+                self.weights[norm_index, test_index] = norm_set.weights[row]
+                self.residual_sd[norm_index, test_index] = norm_set.residual_sd[row]
+                self.min_raw[norm_index, test_index], self.max_raw[norm_index, test_index] = \
+                    norm_set.raw_score_range.get(test)
+                lookup = norm_set.lookup.get(test)
+                self.lookup[norm_index, test_index, :len(lookup)] = lookup
+
+        # Expected score of every norm set and test for every combination of age, sex and education
+        age, sex, education = np.meshgrid(np.arange(MAX_AGE + 1),
+                                          np.arange(MAX_SEX + 1),
+                                          np.arange(MAX_EDUCATION + 1), indexing='ij')
+        design_grid = np.stack([np.ones_like(age), age, age ** 2, sex, education], axis=-1).astype(np.float64)
+        self.expected_scores = np.ascontiguousarray(np.einsum('agew,ntw->ntage', design_grid, self.weights))
+
+        for array in (self.weights, self.residual_sd, self.lookup, self.min_raw, self.max_raw, self.expected_scores):
+            array.setflags(write=False)
+
+    def norm_index(self, norms):
+        """ Index of every norm set name in norms, raise a ValueError for unknown names
+
+        :param norms: 1-D array-like of norm set names
+        :return: 1-D intp array
+        """
+        codes = pd.Categorical(norms, categories=self.names).codes
+        if np.any(codes < 0):
+            unknown = sorted(set(pd.Series(norms)[codes < 0].astype(str)))
+            raise ValueError(f'Unknown norm sets {unknown}, choose from {self.names}')
+        return codes.astype(np.intp)
+
+    def test_index(self, test):
+        """ Index of a test, raise a ValueError for unknown tests """
+        if test not in self.tests:
+            raise ValueError(f'Unknown test "{test}", choose from {self.tests}')
+        return self.tests.index(test)
+
+    def raw_score_range(self, test):
+        """ Smallest and largest valid raw score on a test over all norm sets """
+        ranges = [norm_set.raw_score_range.get(test) for norm_set in self.norm_sets.values()
+                  if test in norm_set.raw_score_range]
+        return min(low for low, _ in ranges), max(high for _, high in ranges)
+
+
+def get_norm_files(norm_paths):
+    """ The norm set files and the conversion table files they refer to
+
+    :param norm_paths: list of paths to norm set files
+    :return: sorted list of paths
+    """
+    conversion_tables = {file_name for path in norm_paths
+                         for file_name in pd.read_csv(path, usecols=['conversion_table'])['conversion_table']}
+    return sorted(norm_paths) + sorted(os.path.join(ROOT_DIR, 'data', file_name) for file_name in conversion_tables)
+
+
+def get_norm_registry():
+    """ Cached NormRegistry, reloaded when a norm set or one of its conversion table files changes """
+    norm_paths = sorted(glob.glob(os.path.join(NORMS_DIR, '*.csv')))
+    norm_files = asset_cache.get('norm_files', norm_paths, lambda: get_norm_files(norm_paths))
+    return asset_cache.get('norm_registry', norm_files, NormRegistry)
@@ -0,0 +1,193 @@
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+import numpy as np
+import pandas as pd
+from export import export_chunks
+from functions import batch_impaired_or_not, batch_impairment_matrix, batch_z_scores
+from ingest import CHUNK_SIZE, assemble_output, concat_error_tables, get_file_format, read_chunks
+from summary import CohortSummary
+from validation import ERROR_TABLE_COLUMNS, get_test_columns, validate
+
+# Upper bound on the memory held by cached upload results, shared by all sessions of the process
+RESULT_CACHE_MB = int(os.environ.get('BICAMS_RESULT_CACHE_MB', 512))
+
+
+def get_nbytes(value):
+    """ Approximate memory held by a cached value """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(index=True, deep=True)))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(get_nbytes(element) for element in value)
+    return 64
+
+
+class ResultCache:
+    """ Process-wide least-recently-used cache, bounded by the total size of its values
+
+    When adding a value exceeds max_bytes, the least recently used values are evicted first.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """ Get a value from the cache, computing and storing it if it is missing
+
+        :param key: hashable key of the value
+        :param compute: callable without arguments that computes the value
+        :return: the cached or computed value
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+
+        # Compute outside the lock, so that other sessions are not blocked meanwhile
+        value = compute()
+        nbytes = get_nbytes(value)
+        with self._lock:
+            if key not in self._entries and nbytes <= self.max_bytes:
+                self._entries[key] = (value, nbytes)
+                self.nbytes += nbytes
+                while self.nbytes > self.max_bytes:
+                    _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                    self.nbytes -= evicted_nbytes
+        return value
+
+    def stats(self):
+        """ Hit/miss counters, number of entries and memory held """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                    'mb': self.nbytes / 1e6, 'max_mb': self.max_bytes / 1e6}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+result_cache = ResultCache(max_bytes=RESULT_CACHE_MB * 1000000)
+
+
+class UploadPipeline:
+    """ Conversion of an uploaded file, split in stages that are cached by the content hash of the upload
+
+    parse + validate -> z-scores -> impairment flags -> export. Every stage only depends on the stages before it and
+    its own parameters, so e.g. changing the cutoff only recomputes the impairment flags and the export.
+    """
+
+    def __init__(self, upload_hash, file_name, upload_bytes, norm_registry=None):
+        """
+        :param upload_hash: str, hash of the uploaded bytes, e.g. sha256
+        :param file_name: str, name of the uploaded file, used to derive its format
+        :param upload_bytes: bytes of the uploaded file
+        :param norm_registry: NormRegistry to normalize with. Defaults to the norm sets in data/norms
+        """
+        self.upload_hash = upload_hash
+        self.file_name = file_name
+        self.upload_bytes = upload_bytes
+        self.norm_registry = norm_registry
+
+    def validated(self):
+        """ Parse and validate the upload chunk by chunk
+
+        :return: valid_data: pd dataframe with the rows that passed validation --
+                 error_table: pd dataframe with the values that did not pass validation
+        """
+        return result_cache.get((self.upload_hash, 'validated'), self._validate)
+
+    def _validate(self):
+        valid_chunks = []
+        error_tables = []
+        for chunk in read_chunks(BytesIO(self.upload_bytes), file_format=get_file_format(self.file_name)):
+            valid_chunk, error_table = validate(chunk, self.norm_registry)
+            valid_chunks.append(valid_chunk)
+            if not error_table.empty:
+                error_tables.append(error_table)
+        if not valid_chunks:
+            return pd.DataFrame(), pd.DataFrame(columns=ERROR_TABLE_COLUMNS)
+        return pd.concat(valid_chunks), concat_error_tables(error_tables)
+
+    def z_scores(self):
+        """ z-scores of the valid rows, a pd dataframe with one '<test>_z' column per test """
+        return result_cache.get((self.upload_hash, 'z_scores'), self._z_scores)
+
+    def _z_scores(self):
+        valid_data = self.validated()[0]
+        if valid_data.empty:
+            return pd.DataFrame()
+        return batch_z_scores(demographics=valid_data,
+                              raw_scores=valid_data[get_test_columns(valid_data.columns, self.norm_registry)],
+                              norm_registry=self.norm_registry)
+
+    def impaired(self, z_cutoff):
+        """ Impairment flags of the valid rows, a pd dataframe with one '<test>_imp' column per test """
+        return result_cache.get((self.upload_hash, 'impaired', z_cutoff),
+                                lambda: batch_impaired_or_not(self.z_scores(), z_cutoff))
+
+    def impairment_matrix(self, cutoffs):
+        """ Impairment flags of the valid rows for several cutoffs, with one '<test>_imp@<cutoff>' column per test and
+        cutoff """
+        return result_cache.get((self.upload_hash, 'impairment_matrix', tuple(cutoffs)),
+                                lambda: batch_impairment_matrix(self.z_scores(), cutoffs))
+
+    def summary(self, z_cutoff, cutoffs=()):
+        """ CohortSummary of the z-scores, computed chunk by chunk """
+        return result_cache.get((self.upload_hash, 'summary', z_cutoff, tuple(cutoffs)),
+                                lambda: self._summary(z_cutoff, cutoffs))
+
+    def _summary(self, z_cutoff, cutoffs):
+        valid_data = self.validated()[0]
+        z_scores = self.z_scores()
+        cohort_summary = CohortSummary([column[:-len('_z')] for column in z_scores.columns], z_cutoff, cutoffs)
+        for start in range(0, len(z_scores), CHUNK_SIZE):
+            cohort_summary.update(pd.concat([valid_data.iloc[start:start + CHUNK_SIZE],
+                                             z_scores.iloc[start:start + CHUNK_SIZE]], axis=1))
+        return cohort_summary
+
+    def transformed(self, z_cutoff, all_cutoffs=()):
+        """ The valid input data with age^2, the '<test>_z' and the '<test>_imp' columns, followed by the
+        '<test>_imp@<cutoff>' columns of all_cutoffs """
+        valid_data = self.validated()[0]
+        if valid_data.empty:
+            return pd.DataFrame()
+        return assemble_output(valid_data, self._blocks(z_cutoff, all_cutoffs))
+
+    def preview(self, z_cutoff, all_cutoffs=(), rows=5):
+        """ The first rows of transformed, laid out from the first rows of every stage only """
+        valid_data = self.validated()[0]
+        if valid_data.empty:
+            return pd.DataFrame()
+        blocks = self._blocks(z_cutoff, all_cutoffs)
+        return assemble_output(valid_data.head(rows), [block.head(rows) for block in blocks])
+
+    def _blocks(self, z_cutoff, all_cutoffs):
+        blocks = [self.z_scores(), self.impaired(z_cutoff)]
+        if all_cutoffs:
+            blocks.append(self.impairment_matrix(all_cutoffs))
+        return blocks
+
+    def export(self, z_cutoff, export_format, all_cutoffs=()):
+        """ Bytes of the transformed data in export_format ('xlsx', 'csv' or 'parquet') """
+        return result_cache.get((self.upload_hash, 'export', z_cutoff, export_format, tuple(all_cutoffs)),
+                                lambda: self._export(z_cutoff, export_format, all_cutoffs))
+
+    def _export(self, z_cutoff, export_format, all_cutoffs):
+        transformed_data = self.transformed(z_cutoff, all_cutoffs)
+        return export_chunks((transformed_data.iloc[start:start + CHUNK_SIZE]
+                              for start in range(0, len(transformed_data), CHUNK_SIZE)), export_format)
@@ -0,0 +1,41 @@
+""" Load the assets and heavy libraries of the application in the background, once per process
+
+The first session of a fresh process starts this thread before rendering, so that the norm sets, the reference curve,
+the mock preview and matplotlib are loaded while the top of the page is already being sent. Assets are loaded through
+load_data.asset_cache and imports are serialized by Python, so the page waits for whatever is not ready yet instead of
+loading it twice.
+"""
+import importlib
+import threading
+from load_data import get_mock_preview, get_reference_density
+from metrics import measure
+from norms import get_norm_registry
+
+# Imported lazily by the application when the first figure is drawn, pyplot by st.pyplot
+LAZY_MODULES = ['matplotlib.figure', 'matplotlib.pyplot']
+
+_prewarm_lock = threading.Lock()
+_prewarm_thread = None
+
+
+def prewarm():
+    """ Load the assets and import the lazily imported modules """
+    with measure('prewarm'):
+        get_norm_registry()
+        get_reference_density()
+        get_mock_preview()
+        for module in LAZY_MODULES:
+            importlib.import_module(module)
+
+
+def start_prewarm():
+    """ Run prewarm in a daemon thread, unless it was started before in this process
+
+    :return: the prewarm thread
+    """
+    global _prewarm_thread
+    with _prewarm_lock:
+        if _prewarm_thread is None:
+            _prewarm_thread = threading.Thread(target=prewarm, name='bicams-prewarm', daemon=True)
+            _prewarm_thread.start()
+    return _prewarm_thread
@@ -0,0 +1,145 @@
+import numpy as np
+import pandas as pd
+
+# Groups of the breakdowns, the age bands are [lower, upper) intervals
+GROUP_COLUMNS = ['sex', 'education', 'age band']
+AGE_BAND_EDGES = [0, 30, 40, 50, 60, 70, 126]
+AGE_BAND_LABELS = ['<30', '30-39', '40-49', '50-59', '60-69', '70+']
+
+# Bins of the z-score histograms. z-scores outside the range are counted in the first or last bin
+HISTOGRAM_EDGES = np.linspace(-4, 4, 33)
+
+
+def merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    """ Combine the count, mean and sum of squared deviations (M2) of two sets of values
+
+    The parallel form of Welford's update (Chan et al.), so that chunks can be added one at a time without keeping
+    their values. Works element-wise on arrays.
+
+    :return: count, mean, m2 of the combined values
+    """
+    count = count_a + count_b
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = mean_b - mean_a
+        mean = np.where(count > 0, mean_a + delta * count_b / count, 0.0)
+        m2 = np.where(count > 0, m2_a + m2_b + delta ** 2 * count_a * count_b / count, 0.0)
+    return count, mean, m2
+
+
+def get_age_bands(age):
+    """ Age band label of every age, see AGE_BAND_LABELS """
+    return pd.cut(age, bins=AGE_BAND_EDGES, labels=AGE_BAND_LABELS, right=False)
+
+
+class CohortSummary:
+    """ Summary statistics of the z-scores of a cohort, computed in one pass over chunks of the enriched data
+
+    Only counts, means and sums of squared deviations are kept, so memory use does not depend on the number of rows.
+    """
+
+    def __init__(self, tests, z_cutoff, cutoffs=()):
+        """
+        :param tests: list of test names, e.g. ['sdmt', 'bvmt', 'cvlt']
+        :param z_cutoff: float, the cutoff of the impairment percentages of the breakdowns
+        :param cutoffs: list of cutoffs of the prevalence table, defaults to z_cutoff
+        """
+        self.tests = list(tests)
+        self.z_cutoff = z_cutoff
+        self.cutoffs = np.asarray(sorted(set(cutoffs) | {z_cutoff}), dtype=np.float64)
+        n_tests = len(self.tests)
+
+        self.rows = 0
+        self.count = np.zeros(n_tests)
+        self.mean = np.zeros(n_tests)
+        self.m2 = np.zeros(n_tests)
+        self.impaired = np.zeros((n_tests, len(self.cutoffs)))
+        self.histogram = np.zeros((n_tests, len(HISTOGRAM_EDGES) - 1), dtype=np.int64)
+
+        # Per group column: dataframe indexed by (group, test) with the columns count, mean, m2 and impaired
+        self.groups = dict()
+
+    def update(self, transformed_chunk):
+        """ Add a chunk of enriched data
+
+        :param transformed_chunk: pd dataframe with the columns 'age', 'sex', 'education' and '<test>_z' of every test
+        """
+        if transformed_chunk.empty:
+            return
+        z_columns = [test + '_z' for test in self.tests]
+        z_values = transformed_chunk.reindex(columns=z_columns).to_numpy(dtype=np.float64)
+        valid = ~np.isnan(z_values)
+        self.rows += len(transformed_chunk)
+
+        # Moments of the chunk, merged into the running moments
+        count = valid.sum(axis=0)
+        with np.errstate(invalid='ignore'):
+            mean = np.where(count > 0, np.nansum(z_values, axis=0) / np.maximum(count, 1), 0.0)
+            m2 = np.nansum((z_values - mean) ** 2, axis=0)
+        self.count, self.mean, self.m2 = merge_moments(self.count, self.mean, self.m2, count, mean, m2)
+
+        with np.errstate(invalid='ignore'):
+            self.impaired += (z_values[:, :, np.newaxis] <= self.cutoffs).sum(axis=0)
+        clipped = np.clip(z_values, HISTOGRAM_EDGES[0], HISTOGRAM_EDGES[-1])
+        for test_index in range(len(self.tests)):
+            self.histogram[test_index] += np.histogram(clipped[valid[:, test_index], test_index],
+                                                       bins=HISTOGRAM_EDGES)[0]
+
+        # Grouped moments and impairment counts, in long format with one row per subject and test
+        long_data = pd.DataFrame({'sex': np.repeat(transformed_chunk['sex'].to_numpy(), len(self.tests)),
+                                  'education': np.repeat(transformed_chunk['education'].to_numpy(), len(self.tests)),
+                                  'age band': np.repeat(get_age_bands(transformed_chunk['age']), len(self.tests)),
+                                  'test': np.tile(self.tests, len(transformed_chunk)),
+                                  'z': z_values.ravel()})
+        long_data = long_data[~np.isnan(long_data['z'].to_numpy())]
+        long_data['impaired'] = long_data['z'] <= self.z_cutoff
+        for column in GROUP_COLUMNS:
+            grouped = long_data.groupby([column, 'test'], observed=True)
+            chunk_groups = pd.DataFrame({'count': grouped['z'].count(),
+                                         'mean': grouped['z'].mean(),
+                                         'm2': grouped['z'].var(ddof=0) * grouped['z'].count(),
+                                         'impaired': grouped['impaired'].sum()})
+            previous = self.groups.get(column)
+            if previous is None:
+                self.groups[column] = chunk_groups
+                continue
+            index = previous.index.union(chunk_groups.index)
+            previous = previous.reindex(index, fill_value=0)
+            chunk_groups = chunk_groups.reindex(index, fill_value=0)
+            count, mean, m2 = merge_moments(previous['count'].to_numpy(), previous['mean'].to_numpy(),
+                                            previous['m2'].to_numpy(), chunk_groups['count'].to_numpy(),
+                                            chunk_groups['mean'].to_numpy(), chunk_groups['m2'].to_numpy())
+            self.groups[column] = pd.DataFrame({'count': count, 'mean': mean, 'm2': m2,
+                                                'impaired': previous['impaired'] + chunk_groups['impaired']},
+                                               index=index)
+
+    def overall(self):
+        """ Number of z-scores, mean and SD per test """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sd = np.sqrt(self.m2 / (self.count - 1))
+        return pd.DataFrame({'n': self.count.astype(np.int64), 'mean': self.mean,
+                             'sd': np.where(self.count > 1, sd, np.nan)},
+                            index=pd.Index(self.tests, name='test'))
+
+    def prevalence(self):
+        """ Percentage of impaired subjects per test (rows) and cutoff (columns). Missing z-scores are not counted """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            prevalence = 100 * self.impaired / self.count[:, np.newaxis]
+        return pd.DataFrame(prevalence,
+                            index=pd.Index(self.tests, name='test'),
+                            columns=pd.Index([f'{cutoff:g}' for cutoff in self.cutoffs], name='z cutoff'))
+
+    def breakdown(self, column):
+        """ Number of z-scores, mean, SD and percentage impaired at z_cutoff per group and test
+
+        :param column: str, one of GROUP_COLUMNS
+        :return: pd dataframe indexed by (group, test)
+        """
+        groups = self.groups.get(column)
+        if groups is None:
+            return pd.DataFrame(columns=['n', 'mean', 'sd', '% impaired'])
+        count = groups['count'].to_numpy(dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sd = np.where(count > 1, np.sqrt(groups['m2'].to_numpy() / (count - 1)), np.nan)
+            impaired = 100 * groups['impaired'].to_numpy() / count
+        return pd.DataFrame({'n': count.astype(np.int64), 'mean': groups['mean'].to_numpy(), 'sd': sd,
+                             '% impaired': impaired}, index=groups.index).sort_index()
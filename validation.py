@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+from metrics import timed
+from norms import DEFAULT_NORM, get_norm_registry
+
+DEMOGRAPHIC_COLUMNS = ['age', 'sex', 'education']
+
+# Optional column with the name of the norm set of every row
+NORM_COLUMN = 'norm'
+
+error_dict = {'columns': 'Please be sure to use the correct column names and that they are lower case',
+              'age': 'Please use age values between 0 and 125 years, and only use integer values',
+              'sex': 'Please assure the following encoding: Male = 1, Female = 2',
+              'education': 'Please use education levels that are encoded as 6, 12, 13, 15, 17 or 21 years',
+              'norm': 'Please use the name of one of the norm sets in data/norms',
+              'no_norms': 'The norm set of this row has no norms for this test',
+              'norm_range': 'The norm set of this row has no norms for this raw score'}
+
+# Integer columns with an inclusive (min, max) range. The tests use the min_raw and max_raw of their norm sets
+allowed_range_dict = {'age': (0, 125)}
+
+# Integer columns with a fixed set of categories
+allowed_category_dict = {'sex': [1, 2],
+                         'education': [6, 12, 13, 15, 17, 21]}
+
+ERROR_TABLE_COLUMNS = ['row', 'column', 'value', 'error']
+
+
+def get_test_columns(columns, norm_registry=None):
+    """ The columns that hold raw scores of a test known to the norm sets
+
+    :param columns: iterable of column names of the input data
+    :param norm_registry: NormRegistry with the norm sets, defaults to the norm sets in data/norms
+    :return: list of column names
+    """
+    tests = (norm_registry or get_norm_registry()).tests
+    return [column for column in columns if column in tests]
+
+
+def check_columns(columns, norm_registry=None):
+    """ Check whether the input data has usable column names, raise a ValueError if not
+
+    :param columns: iterable of column names of the input data
+    :param norm_registry: NormRegistry with the norm sets, defaults to the norm sets in data/norms
+    """
+    norm_registry = norm_registry or get_norm_registry()
+    columns = list(columns)
+    test_columns = get_test_columns(columns, norm_registry)
+    unknown_columns = [column for column in columns
+                       if column not in DEMOGRAPHIC_COLUMNS + [NORM_COLUMN] and column not in test_columns]
+    missing_columns = [column for column in DEMOGRAPHIC_COLUMNS if column not in columns]
+    if unknown_columns or missing_columns or not test_columns:
+        details = []
+        if unknown_columns:
+            details.append(f'unknown columns: {unknown_columns}')
+        if missing_columns:
+            details.append(f'missing columns: {missing_columns}')
+        if not test_columns:
+            details.append(f'at least one of {norm_registry.tests} is required')
+        raise ValueError(f"{error_dict.get('columns')} ({'; '.join(details)})")
+
+
+@timed('validate')
+def validate(input_data, norm_registry=None):
+    """ Check every value of the input data in a single vectorized pass
+
+    :param input_data: pd dataframe with the input data, its index being the row numbers in the input file
+    :param norm_registry: NormRegistry with the norm sets, defaults to the norm sets in data/norms
+    :return: valid_data: pd dataframe with the rows without any error, with uint8 (or wider) columns for age and the
+             tests and categorical columns for sex, education and the optional norm column --
+             error_table: pd dataframe with one row per invalid value and the columns 'row', 'column', 'value' and 'error'
+    """
+    norm_registry = norm_registry or get_norm_registry()
+    check_columns(input_data.columns, norm_registry)
+    test_columns = get_test_columns(input_data.columns, norm_registry)
+
+    # Norm set of every row, -1 for unknown names that are reported below
+    if NORM_COLUMN in input_data:
+        norm_codes = pd.Categorical(input_data[NORM_COLUMN].to_numpy(), categories=norm_registry.names).codes
+    else:
+        norm_codes = np.full(len(input_data), norm_registry.norm_index([DEFAULT_NORM])[0])
+    known_norm = norm_codes >= 0
+
+    valid_rows = np.ones(len(input_data), dtype=bool)
+    valid_columns = dict()
+    error_tables = []
+    for column in input_data.columns:
+        raw_values = input_data[column]
+
+        if column == NORM_COLUMN:
+            # Names of norm sets, the only non-numeric column
+            values = raw_values.to_numpy()
+            valid_columns[column] = values
+            invalid = ~known_norm
+            error_rows = np.flatnonzero(invalid)
+            messages = np.full(len(error_rows), error_dict.get(column) + f' ({norm_registry.names})')
+        else:
+            values = pd.to_numeric(raw_values, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+            valid_columns[column] = values
+
+            # Missing or non-numeric values, then non-integer values, then values outside the allowed range/categories
+            not_numeric = np.isnan(values)
+            not_integer = ~not_numeric & (values % 1 != 0)
+            if column in allowed_category_dict:
+                out_of_range = ~not_numeric & ~np.isin(values, allowed_category_dict.get(column))
+                message = error_dict.get(column)
+            else:
+                lower, upper = allowed_range_dict.get(column) or norm_registry.raw_score_range(column)
+                out_of_range = (values < lower) | (values > upper)
+                message = error_dict.get(column, f'Please use {column} values between {lower} and {upper}')
+            invalid = not_numeric | not_integer | out_of_range
+
+            # Tests are also checked against the norm set of their row, which may not cover the test or every score
+            no_norms = outside_norms = np.zeros(len(values), dtype=bool)
+            if column in test_columns:
+                test_index = norm_registry.test_index(column)
+                norm_lower = norm_registry.min_raw[norm_codes, test_index]
+                norm_upper = norm_registry.max_raw[norm_codes, test_index]
+                no_norms = ~invalid & known_norm & np.isnan(norm_lower)
+                outside_norms = ~invalid & known_norm & ((values < norm_lower) | (values > norm_upper))
+                invalid |= no_norms | outside_norms
+
+            # Messages are only built for the invalid values
+            error_rows = np.flatnonzero(invalid)
+            messages = np.select([not_numeric[error_rows], not_integer[error_rows], no_norms[error_rows],
+                                  outside_norms[error_rows]],
+                                 ['Missing or non-numeric value', 'Non-integer value', error_dict.get('no_norms'),
+                                  error_dict.get('norm_range')],
+                                 default=message)
+
+        if len(error_rows):
+            valid_rows[error_rows] = False
+            error_tables.append(pd.DataFrame({'row': input_data.index[error_rows],
+                                              'column': column,
+                                              'value': raw_values.iloc[error_rows].astype(str).to_numpy(),
+                                              'error': messages}))
+
+    if error_tables:
+        error_table = pd.concat(error_tables, ignore_index=True).sort_values('row', kind='stable')
+        error_table = error_table.reset_index(drop=True)
+    else:
+        error_table = pd.DataFrame(columns=ERROR_TABLE_COLUMNS)
+
+    # Every remaining value is valid and is stored in the smallest dtype that holds it: unsigned integers for the columns
+    # with a range, categoricals for the columns with a fixed set of categories and for the norm sets
+    compact_columns = dict()
+    for column, values in valid_columns.items():
+        values = values[valid_rows]
+        if column == NORM_COLUMN:
+            compact_columns[column] = pd.Categorical(values, categories=norm_registry.names)
+        elif column in allowed_category_dict:
+            compact_columns[column] = pd.Categorical(values.astype(np.int64),
+                                                     categories=allowed_category_dict.get(column))
+        else:
+            upper = (allowed_range_dict.get(column) or norm_registry.raw_score_range(column))[1]
+            compact_columns[column] = values.astype(np.min_scalar_type(int(upper)))
+    valid_data = pd.DataFrame(compact_columns, index=input_data.index[valid_rows])
+
+    return valid_data, error_table